@@ -0,0 +1,57 @@
+import heapq
+
+
+class FingerAllocator:
+    """
+    Sweep-line finger allocation.
+
+    Intervals are visited by start time; fingers that are released by then go back to
+    the idle heap and the lowest idle finger id is taken. An interval that finds no
+    idle finger is dropped. O(n log k) for n intervals and k fingers.
+    """
+
+    def __init__(self, fingers=range(1, 6)):
+        self.fingers = list(fingers)
+        self.peak_concurrency = 0
+        self.allocated = 0
+        self.dropped: list[int] = []
+
+    def allocate(self, intervals: list[tuple[float, float]]) -> list[int]:
+        """
+        :param intervals: list of (from_time, to_time), None entries are skipped
+        :return: finger id for each interval, None if dropped or skipped
+        """
+        result = [None] * len(intervals)
+        order = sorted(
+            (i for i, interval in enumerate(intervals) if interval is not None),
+            key=lambda i: intervals[i],
+        )
+
+        idle = list(self.fingers)
+        heapq.heapify(idle)
+        busy: list[tuple[float, int]] = []
+
+        for i in order:
+            from_time, to_time = intervals[i]
+            while busy and busy[0][0] <= from_time:
+                heapq.heappush(idle, heapq.heappop(busy)[1])
+
+            if not idle:
+                self.dropped.append(i)
+                continue
+
+            finger = heapq.heappop(idle)
+            heapq.heappush(busy, (to_time, finger))
+            result[i] = finger
+            self.allocated += 1
+            self.peak_concurrency = max(self.peak_concurrency, len(busy))
+
+        return result
+
+    def stats(self) -> dict:
+        return {
+            "fingers": len(self.fingers),
+            "allocated": self.allocated,
+            "peak_concurrency": self.peak_concurrency,
+            "dropped": len(self.dropped),
+        }
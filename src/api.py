@@ -1,42 +1,391 @@
 import logging
+import pickle
+import queue
+import threading
+import time
+import zlib
+from collections import OrderedDict
+
 import requests
 from diskcache import Cache
 from urllib3.util.retry import Retry
 from requests.adapters import HTTPAdapter
 
+from chartpack import ChartPack, ChartPackWriter
+
+# Concurrent downloads of a prefetch, and connections kept open to Bestdori
+PREFETCH_WORKERS = 8
+MEMORY_CACHE_SIZE = 64 * 1024 * 1024
+
+
+class MemoryCache:
+    """
+    LRU of decoded values, evicting the least recently used ones once their total
+    size goes over max_size bytes. A value is sized by its serialized length.
+
+    Values are shared between callers, so they must not be modified.
+    """
+
+    def __init__(self, max_size: int):
+        self.max_size = max_size
+        self.size = 0
+        self._items: OrderedDict[str, tuple[object, int]] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._items)
+
+    def get(self, key):
+        with self._lock:
+            item = self._items.get(key)
+            if item is None:
+                return None
+            self._items.move_to_end(key)
+            return item[0]
+
+    def set(self, key, value, size: int):
+        if size > self.max_size:
+            return
+        with self._lock:
+            if (old := self._items.pop(key, None)) is not None:
+                self.size -= old[1]
+            self._items[key] = (value, size)
+            self.size += size
+            while self.size > self.max_size:
+                _, (_, evicted) = self._items.popitem(last=False)
+                self.size -= evicted
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+            self.size = 0
+
+
+class PrefetchJob:
+    """Progress of a BestdoriAPI.prefetch_charts run, updated by its worker threads."""
+
+    def __init__(self, charts: list[tuple[str, str]]):
+        self.total = len(charts)
+        self.fetched = 0
+        self.cached = 0
+        self.failed = 0
+        self.errors: dict[str, str] = {}
+        self._queue = queue.Queue()
+        for chart in charts:
+            self._queue.put(chart)
+        self._lock = threading.Lock()
+        self._running = 0
+        self._finished = threading.Event()
+        self._cancelled = False
+
+    @property
+    def done(self) -> int:
+        return self.fetched + self.cached + self.failed
+
+    @property
+    def finished(self) -> bool:
+        return self._finished.is_set()
+
+    def wait(self, timeout: float = None) -> bool:
+        return self._finished.wait(timeout)
+
+    def cancel(self):
+        """Stop after the downloads in flight."""
+        self._cancelled = True
+
+    def progress(self) -> dict:
+        return {
+            "total": self.total,
+            "fetched": self.fetched,
+            "cached": self.cached,
+            "failed": self.failed,
+        }
+
+    def _start(self, workers: int):
+        self._running = min(workers, self.total)
+        if not self._running:
+            self._finished.set()
+            return
+        for _ in range(self._running):
+            threading.Thread(target=self._work, daemon=True).start()
+
+    def _work(self):
+        while not self._cancelled:
+            try:
+                song_id, difficulty = self._queue.get_nowait()
+            except queue.Empty:
+                break
+            try:
+                if BestdoriAPI.has_chart(song_id, difficulty):
+                    result = "cached"
+                else:
+                    BestdoriAPI.get_chart(song_id, difficulty)
+                    result = "fetched"
+            except Exception as e:
+                result = "failed"
+                self.errors[f"{song_id}-{difficulty}"] = repr(e)
+                BestdoriAPI._logger.warning(
+                    f"Failed to prefetch {song_id}-{difficulty}: {e!r}"
+                )
+            with self._lock:
+                setattr(self, result, getattr(self, result) + 1)
+                done = self.done
+            if not done % max(1, self.total // 10):
+                BestdoriAPI._logger.info(f"Prefetch progress: {self.progress()}")
+
+        with self._lock:
+            self._running -= 1
+            if self._running:
+                return
+        BestdoriAPI._logger.info(f"Prefetch finished: {self.progress()}")
+        self._finished.set()
+
 
 class BestdoriAPI:
     base = "https://bestdori.com/api"
     _logger = logging.getLogger("BestdoriAPI")
     _cache = Cache("cache")
+    # In front of _cache, holding recently used values decoded
+    _memory = MemoryCache(MEMORY_CACHE_SIZE)
+    # Behind _cache, see use_pack
+    _pack: ChartPack = None
+    _offline = False
+    _stats = {
+        tier: {"hits": 0, "misses": 0, "time": 0.0}
+        for tier in ["memory", "disk", "pack", "network"]
+    }
+    _stats_lock = threading.Lock()
     _session = requests.Session()
     _adapter = HTTPAdapter(
+        pool_connections=1,
+        pool_maxsize=PREFETCH_WORKERS,
         max_retries=Retry(
             total=3,
             backoff_factor=2,
             status_forcelist=[500, 502, 503, 504],
             connect=5,
             read=5,
-        )
+        ),
     )
     _session.mount("http://", _adapter)
     _session.mount("https://", _adapter)
 
+    @staticmethod
+    def _count(tier: str, hit: bool, start: float):
+        with BestdoriAPI._stats_lock:
+            stats = BestdoriAPI._stats[tier]
+            stats["hits" if hit else "misses"] += 1
+            stats["time"] += time.perf_counter() - start
+
+    @staticmethod
+    def _get_cached(cache_name):
+        start = time.perf_counter()
+        value = BestdoriAPI._memory.get(cache_name)
+        if value is not None:
+            BestdoriAPI._count("memory", True, start)
+            return value
+        BestdoriAPI._count("memory", False, start)
+
+        start = time.perf_counter()
+        stored = BestdoriAPI._cache.get(cache_name)
+        if stored is None:
+            BestdoriAPI._count("disk", False, start)
+            return BestdoriAPI._get_packed(cache_name)
+        if isinstance(stored, bytes):
+            data = zlib.decompress(stored)
+            value = pickle.loads(data)
+        else:
+            # Stored as is before values were compressed, compress it now
+            value = stored
+            data = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+            BestdoriAPI._cache.set(cache_name, zlib.compress(data))
+        BestdoriAPI._memory.set(cache_name, value, len(data))
+        BestdoriAPI._count("disk", True, start)
+        return value
+
+    @staticmethod
+    def _get_packed(cache_name):
+        if BestdoriAPI._pack is None:
+            return None
+        start = time.perf_counter()
+        value = BestdoriAPI._pack.get(cache_name)
+        if value is not None:
+            BestdoriAPI._memory.set(
+                cache_name,
+                value,
+                len(pickle.dumps(value, pickle.HIGHEST_PROTOCOL)),
+            )
+        BestdoriAPI._count("pack", value is not None, start)
+        return value
+
+    @staticmethod
+    def _set_cached(cache_name, value, expire=None):
+        data = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+        BestdoriAPI._cache.set(cache_name, zlib.compress(data), expire=expire)
+        BestdoriAPI._memory.set(cache_name, value, len(data))
+
+    @staticmethod
+    def _download(url, headers=None) -> requests.Response:
+        if BestdoriAPI._offline:
+            raise requests.ConnectionError(f"Offline, not downloading {url}")
+        start = time.perf_counter()
+        try:
+            response = BestdoriAPI._session.get(url, headers=headers)
+        except Exception:
+            BestdoriAPI._count("network", False, start)
+            raise
+        BestdoriAPI._count("network", True, start)
+        return response
+
     @staticmethod
     def _fetch_and_cache(url, cache_name, expire=None):
-        if cache_ := BestdoriAPI._cache.get(cache_name):
+        if (cache_ := BestdoriAPI._get_cached(cache_name)) is not None:
             BestdoriAPI._logger.info(f"Cache hit for {cache_name}")
             return cache_
         else:
-            response = BestdoriAPI._session.get(url).json()
-            BestdoriAPI._cache.set(cache_name, response, expire=expire)
+            response = BestdoriAPI._download(url).json()
+            BestdoriAPI._set_cached(cache_name, response, expire=expire)
             BestdoriAPI._logger.info(f"Cache set for {cache_name}")
             return response
 
+    @staticmethod
+    def cache_stats() -> dict:
+        """
+        Hits, misses and mean latency in ms of each tier. For "network" a hit is a
+        request that got a response and a miss one that failed.
+        """
+        with BestdoriAPI._stats_lock:
+            stats = {
+                tier: {
+                    **tier_stats,
+                    "mean_ms": tier_stats["time"]
+                    / max(1, tier_stats["hits"] + tier_stats["misses"])
+                    * 1000,
+                }
+                for tier, tier_stats in BestdoriAPI._stats.items()
+            }
+        stats["memory"]["entries"] = len(BestdoriAPI._memory)
+        stats["memory"]["size"] = BestdoriAPI._memory.size
+        stats["disk"]["size"] = BestdoriAPI._cache.volume()
+        return stats
+
+    @staticmethod
+    def _revalidate_and_cache(url, cache_name, max_age):
+        """
+        Like _fetch_and_cache, but the entry never expires. After max_age seconds the
+        server is asked with its ETag/Last-Modified whether it changed, and it is
+        only downloaded again if it did.
+        :return: value, and the previous value if it was replaced, else None
+        """
+        cache = BestdoriAPI._cache
+        validators_name = f"{cache_name}-validators"
+        cached = BestdoriAPI._get_cached(cache_name)
+        validators = cache.get(validators_name, {})
+        fresh = time.time() - validators.get("checked", 0) < max_age
+        if cached is not None and (fresh or BestdoriAPI._offline):
+            BestdoriAPI._logger.info(f"Cache hit for {cache_name}")
+            return cached, None
+
+        headers = {}
+        if cached is not None:
+            if etag := validators.get("etag"):
+                headers["If-None-Match"] = etag
+            if last_modified := validators.get("last_modified"):
+                headers["If-Modified-Since"] = last_modified
+        try:
+            response = BestdoriAPI._download(url, headers)
+            if response.status_code == 304 and cached is not None:
+                cache.set(validators_name, {**validators, "checked": time.time()})
+                BestdoriAPI._logger.info(f"Cache revalidated for {cache_name}")
+                return cached, None
+            response.raise_for_status()
+            value = response.json()
+        except Exception as e:
+            if cached is None:
+                raise
+            BestdoriAPI._logger.warning(
+                f"Failed to revalidate {cache_name}, using the cached one: {e}"
+            )
+            return cached, None
+
+        BestdoriAPI._set_cached(cache_name, value)
+        cache.set(
+            validators_name,
+            {
+                "etag": response.headers.get("ETag"),
+                "last_modified": response.headers.get("Last-Modified"),
+                "checked": time.time(),
+            },
+        )
+        BestdoriAPI._logger.info(f"Cache set for {cache_name}")
+        return value, cached
+
+    @staticmethod
+    def use_pack(path, offline=False):
+        """
+        Serve entries missing from the cache from a chart pack, see export_pack.
+        :param offline: never touch the network, for when Bestdori is unreachable
+        """
+        BestdoriAPI._pack = ChartPack(path)
+        BestdoriAPI._offline = offline
+        BestdoriAPI._logger.info(
+            f"Using chart pack {path}: {len(BestdoriAPI._pack)} entries"
+            + (", offline" if offline else "")
+        )
+
+    @staticmethod
+    def export_pack(path, charts: list[tuple[str, str]]) -> dict:
+        """
+        Write the song list and charts to a single pack file, downloading the charts
+        that are not cached yet.
+        :param charts: [(song_id, difficulty)]
+        :return: number of charts written, and the errors of those that failed
+        """
+        job = BestdoriAPI.prefetch_charts(charts)
+        job.wait()
+        written = 0
+        with ChartPackWriter(path) as writer:
+            writer.add("allsongs", BestdoriAPI.get_song_list())
+            for song_id, difficulty in charts:
+                cache_name = f"{song_id}-{difficulty}"
+                if (chart := BestdoriAPI._get_cached(cache_name)) is not None:
+                    writer.add(cache_name, chart)
+                    written += 1
+        BestdoriAPI._logger.info(f"Exported {written} charts to {path}")
+        return {"charts": written, "errors": job.errors}
+
     @staticmethod
     def get_song_list():
+        return BestdoriAPI.refresh_song_list()[0]
+
+    @staticmethod
+    def refresh_song_list() -> tuple[dict, dict]:
+        """
+        :return: song list, and the songs "added", "removed" and "changed" since the
+            cached one, or {} if it did not change
+        """
         url = BestdoriAPI.base + "/songs/all.5.json"
-        return BestdoriAPI._fetch_and_cache(url, "allsongs", expire=3600 * 1)
+        songs, previous = BestdoriAPI._revalidate_and_cache(
+            url, "allsongs", max_age=3600 * 1
+        )
+        if previous is None:
+            return songs, {}
+
+        diff = {
+            "added": {id_: songs[id_] for id_ in songs.keys() - previous.keys()},
+            "removed": sorted(previous.keys() - songs.keys()),
+            "changed": {
+                id_: songs[id_]
+                for id_ in songs.keys() & previous.keys()
+                if songs[id_] != previous[id_]
+            },
+        }
+        BestdoriAPI._logger.info(
+            "Song list changed: {} added, {} removed, {} changed".format(
+                len(diff["added"]), len(diff["removed"]), len(diff["changed"])
+            )
+        )
+        return songs, diff
 
     @staticmethod
     def get_chart(song_id: str, difficulty: str):
@@ -44,6 +393,27 @@ class BestdoriAPI:
         url = BestdoriAPI.base + f"/charts/{song_id}/{difficulty}.json"
         return BestdoriAPI._fetch_and_cache(url, cacheid)
 
+    @staticmethod
+    def has_chart(song_id: str, difficulty: str) -> bool:
+        cache_name = f"{song_id}-{difficulty}"
+        return cache_name in BestdoriAPI._cache or (
+            BestdoriAPI._pack is not None and cache_name in BestdoriAPI._pack
+        )
+
+    @staticmethod
+    def prefetch_charts(
+        charts: list[tuple[str, str]], workers: int = PREFETCH_WORKERS
+    ) -> PrefetchJob:
+        """
+        Download charts into the cache in the background, `workers` at a time over the
+        shared session. Charts already cached are skipped.
+        :param charts: [(song_id, difficulty)]
+        """
+        job = PrefetchJob(charts)
+        BestdoriAPI._logger.info(f"Prefetching {job.total} charts")
+        job._start(workers)
+        return job
+
 
 if __name__ == "__main__":
     logging.basicConfig(level=logging.DEBUG)
@@ -1,14 +1,13 @@
 import argparse
-import datetime
 import json
 import logging
-import random
+import multiprocessing
 import re
-import string
 import subprocess
 import sys
 import threading
 import time
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 from typing import Optional, Union
 
@@ -25,8 +24,6 @@ if not config_path.exists():
     config_path.write_text("{}", encoding="utf-8")
 
 
-import numpy as np
-from fuzzywuzzy import process as fzwzprocess
 from maa.context import Context
 from maa.controller import AdbController
 from maa.custom_action import CustomAction, CustomRecognitionResult
@@ -37,63 +34,101 @@ from maa.tasker import Tasker
 from maa.toolkit import AdbDevice, Toolkit
 from minitouchpy import (
     MNT,
-    MNTEvATive7LogEventData,
-    MNTEvent,
-    MNTEventData,
     MNTServerCommunicateType,
 )
 
+import playback
 import player
-from api import BestdoriAPI
+from api import BestdoriAPI, PrefetchJob
+from calibration import calibrate, get_latency
 from chart import Chart, PlayRecord
+from chartcache import CompiledChartCache
+from matcher import SongMatcher
+from precompile import DIFFICULTIES, get_jobs, precompile
 from util import *
 
 MIN_LIVEBOOST = 1
 LIVEMODE = "freelive"
 DIFFICULTY = "hard"
-OFFSET = {"up": 0, "down": 0, "move": 0, "wait": 0.0, "interval": 0.0}
-PHOTOGATE_LATENCY = 30
-DEFAULT_MOVE_SLICE_SIZE = 10
+# Use and update the photogate latency calibrated from the play history of the device
+CALIBRATE_PHOTOGATE = True
 MAX_FAILED_TIMES = 10
-CMD_SLICE_SIZE = 100
+TRACE = False
+# Seconds between song list refreshes in the background
+SONG_LIST_REFRESH_INTERVAL = 3600
+SONG_OCR_ROI = [200, 332, 368, 29]
+# OCR models to read the song name with in order, as nodes reused on every call
+SONG_OCR_PIPELINE = {
+    "_ocrsong_ja_jp": {
+        "recognition": "OCR",
+        "only_rec": True,
+        "roi": SONG_OCR_ROI,
+        "model": "ppocr_v3/ja_jp",
+    },
+    "_ocrsong_default": {
+        "recognition": "OCR",
+        "only_rec": True,
+        "roi": SONG_OCR_ROI,
+    },
+}
+# "early-exit": skip the next models once a match scores SONG_MATCH_CONFIDENCE
+# "parallel": run every model at once
+# "sequential": run every model in order
+SONG_OCR_STRATEGY = "early-exit"
+SONG_MATCH_CONFIDENCE = 90
+PLAY_RESULT_FIELDS = {
+    "score": [1028, 192, 144, 35],
+    "maxcombo": [1009, 391, 91, 28],
+    "perfect": [829, 282, 90, 28],
+    "great": [828, 322, 91, 27],
+    "good": [829, 363, 91, 27],
+    "bad": [829, 401, 90, 27],
+    "miss": [830, 438, 91, 28],
+    "fast": [1088, 283, 90, 27],
+    "slow": [1088, 323, 91, 28],
+}
+JUDGEMENT_FIELDS = ["perfect", "great", "good", "bad", "miss"]
+# A node reading the whole result panel at once, and one per field to fall back on
+PLAY_RESULT_PIPELINE = {
+    "_PlayResultRecognition_ocr": {
+        "recognition": "OCR",
+        "roi": [828, 192, 351, 274],
+    },
+    **{
+        f"_PlayResultRecognition_ocr_{field}": {
+            "recognition": "OCR",
+            "only_rec": True,
+            "roi": roi,
+        }
+        for field, roi in PLAY_RESULT_FIELDS.items()
+    },
+}
 
-config = yaml.safe_load(config_path.read_text(encoding="utf-8"))
-maaresource = Resource()
-maatasker = Tasker()
+# Set up by init, so importing autodori, e.g. in a spawned precompile worker, is cheap
+config: dict = {}
+maaresource: Resource = None
+maatasker: Tasker = None
 maacontroller: AdbController = None
 device: AdbDevice = None
-current_player: player.Player = None
+# Identifies the emulator and its capture backend in the play records
+device_key: str = None
 current_orientation: int = 0
-mnt: MNT = None
-all_songs: dict = BestdoriAPI.get_song_list()
-all_song_name_indexes: dict[str, str] = {
-    list(filter(lambda title: title is not None, sinfo["musicTitle"]))[0]: sid
-    for sid, sinfo in all_songs.items()
-}
-current_song_name: str = None
-current_song_id: str = None
-current_chart: Chart = None
-play_failed_times: int = 0
-callback_data: dict = {}
-callback_data_lock = threading.Lock()
-cmd_log_list: list[MNTEvATive7LogEventData] = []
-cmd_log_list_lock = threading.Lock()
-current_version = None
 
 
-def reset_callback_data():
-    global callback_data
-    callback_data = {
-        "wait": {"total": 0, "total_offset": 0.0},
-        "move": {"uncommited": 0, "total": 0, "total_offset": 0.0},
-        "up": {"uncommited": 0, "total": 0, "total_offset": 0.0},
-        "down": {"uncommited": 0, "total": 0, "total_offset": 0.0},
-        "interval": {"total": 0, "total_offset": 0.0},
-        "last_cmd_endtime": -1,
-    }
+def get_song_names(sinfo: dict) -> list[str]:
+    """Titles of a song in every region, without duplicates."""
+    titles = [title for title in sinfo["musicTitle"] if title is not None]
+    return list(dict.fromkeys(titles))
 
 
-reset_callback_data()
+all_songs: dict = {}
+all_song_name_indexes: dict[str, str] = {}
+song_matcher: SongMatcher = None
+current_song_name: str = None
+current_song_id: str = None
+play_failed_times: int = 0
+current_version = None
+song_ocr_executor: ThreadPoolExecutor = None
 
 
 def check_song_available(name, id_, difficulty):
@@ -108,56 +143,49 @@ def check_song_available(name, id_, difficulty):
     return True
 
 
-@maaresource.custom_recognition("SongRecognition")
 class SongRecognition(CustomRecognition):
     def analyze(
         self, context: Context, argv: CustomRecognition.AnalyzeArg
     ) -> Union[CustomRecognition.AnalyzeResult, Optional[RectType]]:
 
-        roi = [200, 332, 368, 29]
-
-        def match(model=None):
-            pplname = "_ocrsong_" + "".join(random.choices(string.ascii_lowercase, k=7))
-            pipeline = {
-                pplname: {
-                    "recognition": "OCR",
-                    "only_rec": True,
-                    "roi": roi,
-                },
-            }
-            if model != None:
-                pipeline[pplname]["model"] = model
+        def match(node):
             try:
                 song_fuzzyname = context.run_recognition(
-                    pplname,
+                    node,
                     argv.image,
-                    pipeline,
+                    SONG_OCR_PIPELINE,
                 ).best_result.text
             except:
                 song_fuzzyname = ""
             return fuzzy_match_song(song_fuzzyname)
 
-        jpmatch = match("ppocr_v3/ja_jp")
-        commonmatch = match()  # , "ppocr_v4/zh_cn")
-        logging.debug(
-            "Match result with ppocr_v3/ja_jp: {}, Match result with default: {}".format(
-                jpmatch, commonmatch
-            )
-        )
-        result = sorted([jpmatch, commonmatch], key=lambda x: x[1], reverse=True)
+        nodes = list(SONG_OCR_PIPELINE)
+        if SONG_OCR_STRATEGY == "parallel":
+            matches = list(song_ocr_executor.map(match, nodes))
+        else:
+            matches = []
+            for node in nodes:
+                matches.append(match(node))
+                if (
+                    SONG_OCR_STRATEGY == "early-exit"
+                    and matches[-1][1] >= SONG_MATCH_CONFIDENCE
+                ):
+                    break
+        logging.debug("Match results: {}".format(dict(zip(nodes, matches))))
+        result = sorted(matches, key=lambda x: x[1], reverse=True)
         if all([r[1] < 50 for r in result]):
             return CustomRecognition.AnalyzeResult(None, "")
         result_music_name = result[0][0]
 
-        if not check_song_available(
-            result_music_name, all_song_name_indexes[result_music_name], DIFFICULTY
+        song_id = all_song_name_indexes.get(result_music_name)
+        if song_id is None or not check_song_available(
+            result_music_name, song_id, DIFFICULTY
         ):
             return CustomRecognition.AnalyzeResult(None, "")
 
-        return CustomRecognition.AnalyzeResult(roi, result_music_name)
+        return CustomRecognition.AnalyzeResult(SONG_OCR_ROI, result_music_name)
 
 
-@maaresource.custom_recognition("LiveBoostEnoughRecognition")
 class LiveBoostEnoughRecognition(CustomRecognition):
     def analyze(
         self, context: Context, argv: CustomRecognition.AnalyzeArg
@@ -194,7 +222,6 @@ class LiveBoostEnoughRecognition(CustomRecognition):
         return CustomRecognition.AnalyzeResult(roi, str(live_boost))
 
 
-@maaresource.custom_action("HandleLiveBoost")
 class HandleLiveBoost(CustomAction):
     def run(self, context: Context, argv: CustomAction.RunArg):
         liveboost = int(argv.reco_detail.best_result.detail)
@@ -205,67 +232,94 @@ class HandleLiveBoost(CustomAction):
         return CustomAction.RunResult(True)
 
 
-@maaresource.custom_recognition("PlayResultRecognition")
+def validate_play_result(result: dict[str, int], note_count: int = None) -> set[str]:
+    """
+    Fields of a play result that are unreadable or do not agree with the others.
+    :param note_count: judged notes of the chart, to check the judgements add up to
+    """
+    invalid = {field for field, value in result.items() if value < 0}
+    if invalid:
+        return invalid
+
+    hits = sum(result[field] for field in ["perfect", "great", "good", "bad"])
+    judged = hits + result["miss"]
+    if note_count and judged != note_count:
+        invalid.update(JUDGEMENT_FIELDS)
+    # Only perfect and great keep the combo, and every other judgement breaks it
+    combo = result["perfect"] + result["great"]
+    breaks = judged - combo
+    if result["maxcombo"] > combo or result["maxcombo"] * (breaks + 1) < combo:
+        invalid.update(["maxcombo", "perfect", "great", "good", "bad", "miss"])
+    if result["fast"] + result["slow"] > hits:
+        invalid.update(["fast", "slow"])
+    return invalid
+
+
 class PlayResultRecognition(CustomRecognition):
     def analyze(
         self, context: Context, argv: CustomRecognition.AnalyzeArg
     ) -> Union[CustomRecognition.AnalyzeResult, Optional[RectType]]:
 
-        types = {
-            "score": {
-                "roi": [1028, 192, 144, 35],
-            },
-            "maxcombo": {
-                "roi": [1009, 391, 91, 28],
-            },
-            "perfect": {
-                "roi": [829, 282, 90, 28],
-            },
-            "great": {
-                "roi": [828, 322, 91, 27],
-            },
-            "good": {
-                "roi": [829, 363, 91, 27],
-            },
-            "bad": {
-                "roi": [829, 401, 90, 27],
-            },
-            "miss": {
-                "roi": [830, 438, 91, 28],
-            },
-            "fast": {
-                "roi": [1088, 283, 90, 27],
-            },
-            "slow": {
-                "roi": [1088, 323, 91, 28],
-            },
-        }
-        result = {type_: {} for type_ in types.keys()}
-        pipeline = {
-            f"_PlayResultRecognition_ocr_{type_}": {
-                "recognition": "OCR",
-                "only_rec": True,
-                "roi": type_value["roi"],
-            }
-            for type_, type_value in types.items()
+        # One OCR over the whole result panel, each text box given to the field it is in
+        texts = {field: [] for field in PLAY_RESULT_FIELDS}
+        try:
+            detail = context.run_recognition(
+                "_PlayResultRecognition_ocr", argv.image, PLAY_RESULT_PIPELINE
+            )
+            for ocr_result in detail.all_results:
+                x, y, w, h = ocr_result.box
+                center = (x + w / 2, y + h / 2)
+                for field, (rx, ry, rw, rh) in PLAY_RESULT_FIELDS.items():
+                    if rx <= center[0] <= rx + rw and ry <= center[1] <= ry + rh:
+                        texts[field].append((x, ocr_result.text))
+                        break
+        except:
+            pass
+
+        def parse(text: str) -> int:
+            digits = re.sub(r"[^0-9]", "", text)
+            return int(digits) if digits else -1
+
+        result = {
+            field: parse("".join(text for _, text in sorted(field_texts)))
+            for field, field_texts in texts.items()
         }
-        for type_, _ in types.items():
-            try:
-                ocrtext = context.run_recognition(
-                    f"_PlayResultRecognition_ocr_{type_}",
-                    argv.image,
-                    pipeline,
-                ).best_result.text
-                type_result = int(ocrtext)
-            except:
-                type_result = -1
-            result[type_] = type_result
+
+        try:
+            note_count = playback.current_chart.get_note_count()
+        except:
+            note_count = None
+
+        # Read what the single pass got wrong again, field by field
+        invalid = validate_play_result(result, note_count)
+        if invalid:
+            logging.debug(
+                "Play result {} failed validation on {}, reading them again".format(
+                    result, sorted(invalid)
+                )
+            )
+            for field in invalid:
+                try:
+                    result[field] = parse(
+                        context.run_recognition(
+                            f"_PlayResultRecognition_ocr_{field}",
+                            argv.image,
+                            PLAY_RESULT_PIPELINE,
+                        ).best_result.text
+                    )
+                except:
+                    result[field] = -1
+            if invalid := validate_play_result(result, note_count):
+                logging.warning(
+                    "Play result {} is inconsistent on {}".format(
+                        result, sorted(invalid)
+                    )
+                )
 
         logging.debug("Play result: {}".format(result))
         return CustomRecognition.AnalyzeResult([0, 0, 0, 0], json.dumps(result))
 
 
-@maaresource.custom_action("SavePlayResult")
 class SavePlayResult(CustomAction):
     def run(self, context: Context, argv: CustomAction.RunArg):
         try:
@@ -280,12 +334,24 @@ class SavePlayResult(CustomAction):
                 playresult = {}
             PlayRecord.create(
                 play_time=int(time.time()),
-                play_offset=OFFSET,
+                play_offset=playback.OFFSET,
                 result=playresult,
                 succeed=succeed,
                 chart_id=current_song_id,
                 difficulty=DIFFICULTY,
+                device=device_key,
+                photogate=playback.last_photogate,
             )
+            playback.last_photogate = None
+            if succeed and CALIBRATE_PHOTOGATE:
+                if (calibration := calibrate(device_key)) is not None:
+                    latency, frame_interval = calibration
+                    playback.PHOTOGATE_LATENCY = latency
+                    playback.PHOTOGATE_FRAME_INTERVAL = frame_interval
+                    logging.info(
+                        f"Photogate latency calibrated to {latency:.1f}ms at "
+                        f"{frame_interval:.1f}ms frames"
+                    )
             if play_failed_times >= MAX_FAILED_TIMES:
                 logging.error("Failed attempts exceed max failed times")
                 context.run_action("close_app")
@@ -296,18 +362,16 @@ class SavePlayResult(CustomAction):
             return CustomAction.RunResult(False)
 
 
-@maaresource.custom_action("Play")
 class Play(CustomAction):
     def run(self, context: Context, argv: CustomAction.RunArg):
         try:
-            play_song()
+            playback.play_song()
             return CustomAction.RunResult(True)
         except Exception as e:
             logging.error(f"Failed when play song: {e}", stack_info=True)
             return CustomAction.RunResult(False)
 
 
-@maaresource.custom_action("SaveSong")
 class SaveSong(CustomAction):
     def run(self, context: Context, argv: CustomAction.RunArg):
         name: CustomRecognitionResult = argv.reco_detail.best_result.detail
@@ -315,8 +379,42 @@ class SaveSong(CustomAction):
         return CustomAction.RunResult(True)
 
 
+def refresh_song_list():
+    """
+    Update all_songs and all_song_name_indexes with the songs that changed.
+    The index is replaced rather than modified, so it can be read while refreshing.
+    """
+    global all_songs, all_song_name_indexes
+    songs, diff = BestdoriAPI.refresh_song_list()
+    all_songs = songs
+    if not diff:
+        return
+
+    stale = set(diff["removed"]) | diff["changed"].keys()
+    indexes = {
+        name: sid for name, sid in all_song_name_indexes.items() if sid not in stale
+    }
+    for sid, sinfo in {**diff["added"], **diff["changed"]}.items():
+        for name in get_song_names(sinfo):
+            indexes[name] = sid
+            song_matcher.add(name)
+    stale_names = all_song_name_indexes.keys() - indexes.keys()
+    all_song_name_indexes = indexes
+    for name in stale_names:
+        song_matcher.remove(name)
+
+
+def _refresh_song_list_periodically():
+    while True:
+        time.sleep(SONG_LIST_REFRESH_INTERVAL)
+        try:
+            refresh_song_list()
+        except Exception as e:
+            logging.error(f"Failed to refresh song list: {e}")
+
+
 def fuzzy_match_song(name):
-    return fzwzprocess.extractOne(name, list(all_song_name_indexes.keys()))
+    return song_matcher.match(name)
 
 
 def _get_orientation():
@@ -350,98 +448,64 @@ def _get_orientation():
 
 
 def save_song(name):
-    global current_song_name, current_song_id, current_chart, current_orientation
+    global current_song_name, current_song_id, current_orientation
     current_song_name = name
     current_song_id = all_song_name_indexes[current_song_name]
-    current_chart = Chart((current_song_id, DIFFICULTY), current_song_name)
-    current_chart.notes_to_actions(current_player.resolution, DEFAULT_MOVE_SLICE_SIZE)
+    chart = playback.current_chart = Chart(
+        (current_song_id, DIFFICULTY), current_song_name
+    )
     current_orientation = _get_orientation()
-    current_chart.actions_to_MNTcmd(
-        (mnt.max_x, mnt.max_y), current_orientation, OFFSET, CMD_SLICE_SIZE
+    chart.load_actions(
+        playback.DEFAULT_MOVE_SLICE_SIZE,
+        playback.MOVE_TOLERANCE,
+        playback.FRAME_QUANTUM,
     )
+    chart.compile_stream(
+        playback.current_player.resolution,
+        (playback.mnt.max_x, playback.mnt.max_y),
+        current_orientation,
+    )
+    if TRACE:
+        chart.dump_debug_config()
     logging.debug("Save song: {}".format(name))
+    logging.debug("Chart cache stats: {}".format(BestdoriAPI.cache_stats()))
+    logging.debug("Compiled chart cache stats: {}".format(CompiledChartCache.stats()))
 
 
-def play_song():
-    logging.info("Start play")
-    cmd_log_list.clear()
-    reset_callback_data()
-
-    def _get_wait_time():
-        wait_for = 0.0
-        index = current_chart.actions_to_cmd_index
-        for action in current_chart.actions[index - CMD_SLICE_SIZE : index]:
-            if action["type"] == "wait":
-                wait_for += action["length"]
-        return wait_for
-
-    def _adjust_offset():
-        global callback_data
-        total_cost = 0.0
-        for type_ in ["up", "down", "move", "wait", "interval"]:
-            type_data = callback_data[type_]
-            total = type_data["total"]
-            if total != 0:
-                total_cost += type_data["total_offset"] - OFFSET[type_] * total
-                OFFSET[type_] = type_data["total_offset"] / total
-
-        current_chart._a2c_offset += total_cost
-        logging.debug("Adjust offset: {}".format(OFFSET))
-        logging.debug("Adjust _actions_to_cmd_offset: {}".format(total_cost))
-
-    wait_first_note()
-
-    while True:
-        current_chart.command_builder.publish(mnt, block=False)
-        wait_time = _get_wait_time()
-        time.sleep(max(0, wait_time - 3) / 1000)
-
-        index = current_chart.actions_to_cmd_index
-        if current_chart.actions[index : index + CMD_SLICE_SIZE]:
-            with callback_data_lock:
-                _adjust_offset()
-                reset_callback_data()
-            current_chart.actions_to_MNTcmd(
-                (mnt.max_x, mnt.max_y), current_orientation, OFFSET, CMD_SLICE_SIZE
-            )
-        else:
-            break
-    time.sleep(2)
-
-
-def wait_first_note():
-    last_color = None
-    waited_frames = 0
-    info = get_runtime_info(current_player.resolution)["wait_first"]
-    from_row, to_row = info["from"], info["to"]
-    freezed = False
+def load_config():
+    global config
+    config = yaml.safe_load(config_path.read_text(encoding="utf-8"))
+    if pack_config := config.get("pack"):
+        BestdoriAPI.use_pack(pack_config["path"], pack_config.get("offline", False))
 
-    while True:
-        try:
-            screen = current_player.ipc_capture_display()
-            cur_color, _ = get_color_eval_in_range(screen, from_row, to_row)
-
-            if last_color is not None:
-                change_score = np.sum(cur_color[0:3] - last_color[0:3])
-                logging.debug(f"Picture changed: {change_score}")
-                if change_score > 3:
-                    if freezed:
-                        logging.debug(
-                            f"The first note falls between {from_row}-{to_row}"
-                        )
-                        time.sleep(PHOTOGATE_LATENCY / 1000)
-                        break
-                else:
-                    if not freezed:
-                        waited_frames += 1
 
-                if not freezed and waited_frames >= 200:
-                    freezed = True
-                    logging.debug("Picture freezed, waiting for the first note...")
+def init():
+    """Load the song list and register the MAA custom tasks, after load_config."""
+    global maaresource, maatasker, song_ocr_executor
+    global all_songs, all_song_name_indexes, song_matcher
 
-            last_color = cur_color
-        except Exception as e:
-            logging.error(f"Failed to get screen: {e}")
+    all_songs = BestdoriAPI.get_song_list()
+    all_song_name_indexes = {
+        name: sid for sid, sinfo in all_songs.items() for name in get_song_names(sinfo)
+    }
+    song_matcher = SongMatcher(all_song_name_indexes)
+    song_ocr_executor = ThreadPoolExecutor(len(SONG_OCR_PIPELINE))
+
+    maaresource = Resource()
+    maatasker = Tasker()
+    for name, recognition in [
+        ("SongRecognition", SongRecognition),
+        ("LiveBoostEnoughRecognition", LiveBoostEnoughRecognition),
+        ("PlayResultRecognition", PlayResultRecognition),
+    ]:
+        maaresource.register_custom_recognition(name, recognition())
+    for name, action in [
+        ("HandleLiveBoost", HandleLiveBoost),
+        ("SavePlayResult", SavePlayResult),
+        ("Play", Play),
+        ("SaveSong", SaveSong),
+    ]:
+        maaresource.register_custom_action(name, action())
 
 
 def init_maa():
@@ -504,54 +568,8 @@ def init_maa():
     logging.info("MAA inited.")
 
 
-def mnt_callback(event: MNTEvent, data: MNTEventData):
-    global callback_data
-    if event == MNTEvent.EVATIVE7_LOG:
-        data: MNTEvATive7LogEventData = data
-
-        cmd = data.cmd
-        cost = data.cost
-
-        with cmd_log_list_lock:
-            cmd_log_list.append(data)
-        cmd_type = cmd.split(" ")[0]
-
-        callback_data_lock.acquire()
-
-        if (last_cmd_endtime := callback_data.get("last_cmd_endtime")) != -1:
-            callback_data["interval"]["total"] += 1
-            callback_data["interval"]["total_offset"] += (
-                data.start_time - last_cmd_endtime
-            )
-        callback_data["last_cmd_endtime"] = data.end_time
-        if cmd_type in ["w"]:
-            callback_data["wait"]["total"] += 1
-            callback_data["wait"]["total_offset"] += cost - int(cmd.split(" ")[-1])
-        elif cmd_type in ["u", "d", "m"]:
-            type_ = {
-                "u": "up",
-                "d": "down",
-                "m": "move",
-            }[cmd_type]
-            callback_data[type_]["uncommited"] += 1
-            callback_data[type_]["total"] += 1
-            callback_data[type_]["total_offset"] += cost
-        elif cmd_type in ["c"]:
-            total_uncommited = 0
-            for type_ in ["up", "down", "move"]:
-                total_uncommited += callback_data[type_]["uncommited"]
-
-            if total_uncommited != 0:
-                for type_ in ["up", "down", "move"]:
-                    callback_data[type_]["total_offset"] += cost * (
-                        callback_data[type_]["uncommited"] / total_uncommited
-                    )
-                    callback_data[type_]["uncommited"] = 0
-        callback_data_lock.release()
-
-
 def init_player_and_mnt():
-    global current_player, mnt
+    global device_key
 
     extra_config = device.config["extras"]
     if "mumu" in extra_config.keys():
@@ -568,36 +586,28 @@ def init_player_and_mnt():
     path = extra_config["path"]
     index = extra_config["index"]
 
-    current_player = player.Player(type_, Path(path), index)
-    mnt = MNT(
+    playback.current_player = player.Player(type_, Path(path), index)
+    device_key = f"{type_}:{path}:{index}"
+    if CALIBRATE_PHOTOGATE and (calibration := get_latency(device_key)) is not None:
+        latency, frame_interval = calibration
+        playback.PHOTOGATE_LATENCY = latency
+        playback.PHOTOGATE_FRAME_INTERVAL = frame_interval
+        logging.info(
+            f"Using calibrated photogate latency {latency:.1f}ms at "
+            f"{frame_interval:.1f}ms frames"
+        )
+    playback.mnt = MNT(
         device.address,
         type_="EvATive7",
         communicate_type=MNTServerCommunicateType.STDIO,
         mnt_asset_path=Path("./assets/minitouch_EvATive7"),
-        callback=mnt_callback,
+        callback=playback.mnt_callback,
         adb_executor=str(device.adb_path.absolute()),
     )
 
     logging.info("Mumu and MNT inited.")
 
 
-def configure_log():
-    logging.basicConfig(
-        level=logging.DEBUG,
-        format="%(asctime)s[%(levelname)s][%(name)s] %(message)s",
-        handlers=[
-            logging.StreamHandler(),
-            logging.FileHandler(
-                "debug/autodori-{}.log".format(
-                    datetime.datetime.now().strftime("%Y%m%d-%H%M%S")
-                ),
-                mode="w",
-                encoding="utf-8",
-            ),
-        ],
-    )
-
-
 def _get_override_pipeline():
     all_pipelines = {}
 
@@ -686,7 +696,7 @@ def main():
     parser.add_argument(
         "--mode",
         type=str,
-        choices=["main"],
+        choices=["main", "precompile", "export-pack"],
         help="Specify the mode to run",
         default="main",
     )
@@ -697,6 +707,24 @@ def main():
         help="Specify the difficulty for main mode",
         default="hard",
     )
+    parser.add_argument(
+        "--difficulties",
+        type=str,
+        nargs="+",
+        choices=DIFFICULTIES,
+        help="Specify the difficulties for precompile and export-pack mode, --difficulty if not given",
+    )
+    parser.add_argument(
+        "--pack",
+        type=Path,
+        default=Path("data/charts.pack"),
+        help="Specify the chart pack file for export-pack mode",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        help="Specify the number of processes for precompile mode, one per CPU if not given",
+    )
     parser.add_argument(
         "--livemode",
         type=str,
@@ -710,6 +738,33 @@ def main():
         default=1,
         help="Specify the min liveboost for main mode. If current liveboost is lower than this value, the script will exit.",
     )
+    parser.add_argument(
+        "--song-ocr-strategy",
+        type=str,
+        choices=["early-exit", "parallel", "sequential"],
+        default="early-exit",
+        help="Specify how the OCR models reading the song name are run",
+    )
+    parser.add_argument(
+        "--trace",
+        action="store_true",
+        help="Write a binary trace of every play to debug/dump, see tracefile.py",
+    )
+    parser.add_argument(
+        "--no-prefetch",
+        action="store_true",
+        help="Specify if skip downloading the charts of --difficulty in the background",
+    )
+    parser.add_argument(
+        "--resync",
+        action="store_true",
+        help="Specify if keep syncing to the notes on screen during play",
+    )
+    parser.add_argument(
+        "--no-calibrate",
+        action="store_true",
+        help="Specify if keep PHOTOGATE_LATENCY instead of calibrating it from the play records",
+    )
     parser.add_argument(
         "--skip-version-check",
         action="store_true",
@@ -717,8 +772,30 @@ def main():
     )
     args = parser.parse_args()
 
-    if args.mode == "main":
+    load_config()
+    if args.mode == "precompile":
+        # Before init, which precompile does not need
+        pack_config = config.get("pack", {})
+        precompile(
+            args.difficulties or [args.difficulty],
+            playback.DEFAULT_MOVE_SLICE_SIZE,
+            playback.MOVE_TOLERANCE,
+            playback.FRAME_QUANTUM,
+            args.workers,
+            pack_config.get("path"),
+            pack_config.get("offline", False),
+        )
+        sys.exit()
+
+    init()
+    if args.mode == "export-pack":
+        BestdoriAPI.export_pack(
+            args.pack, get_jobs(all_songs, args.difficulties or [args.difficulty])
+        )
+        sys.exit()
+    elif args.mode == "main":
         entry = "main"
+        threading.Thread(target=_refresh_song_list_periodically, daemon=True).start()
     else:
         sys.exit(1)
 
@@ -727,19 +804,34 @@ def main():
         if current_version != None:
             check_update()
 
-    global DIFFICULTY, MIN_LIVEBOOST, LIVEMODE
+    global DIFFICULTY, MIN_LIVEBOOST, LIVEMODE, TRACE, SONG_OCR_STRATEGY
+    global CALIBRATE_PHOTOGATE
     DIFFICULTY = args.difficulty
+    playback.RESYNC = args.resync
+    CALIBRATE_PHOTOGATE = not args.no_calibrate
+    TRACE = args.trace
+    SONG_OCR_STRATEGY = args.song_ocr_strategy
     LIVEMODE = args.livemode
     MIN_LIVEBOOST = args.liveboost
+    prefetch_job: PrefetchJob = None
+    if not args.no_prefetch:
+        prefetch_job = BestdoriAPI.prefetch_charts(get_jobs(all_songs, [DIFFICULTY]))
     init_maa()
     init_player_and_mnt()
 
     maatasker.post_task(entry, _get_override_pipeline()).wait().get()
 
-    mnt.stop()
+    playback.mnt.stop()
+    if prefetch_job is not None:
+        if not prefetch_job.finished:
+            prefetch_job.cancel()
+            logging.info(f"Prefetch cancelled: {prefetch_job.progress()}")
+        if prefetch_job.errors:
+            logging.warning(f"Failed to prefetch {len(prefetch_job.errors)} charts")
     logging.debug("Ready to exit")
     sys.exit()
 
 
 if __name__ == "__main__":
+    multiprocessing.freeze_support()
     main()
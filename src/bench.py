@@ -0,0 +1,355 @@
+import argparse
+import copy
+import json
+import logging
+import platform
+import random
+import statistics
+import subprocess
+import time
+import tracemalloc
+from pathlib import Path
+
+import numpy as np
+
+from api import BestdoriAPI
+from chart import COMPILER_VERSION, Chart
+from chartpack import ChartPack
+from precompile import DIFFICULTIES, get_jobs
+
+FIXTURES_PATH = Path("bench/charts")
+MOVE_SLICE_SIZE = 10
+MOVE_TOLERANCE = 16
+FRAME_QUANTUM = 4
+SCREEN_RESOLUTION = (1280, 720)
+MNT_RESOLUTION = (720, 1280)
+ORIENTATION = 1
+CMD_CHUNK_SIZE = 50
+OFFSET = {"up": 0.05, "down": 0.05, "move": 0.05, "wait": 0.3, "interval": 0.02}
+
+
+def generate_chart(
+    notes: int, seed: int, bpm_changes: int = 5, beat_steps=(0, 0.25, 0.5, 0.5, 1)
+) -> list[dict]:
+    """
+    Random chart in Bestdori format: singles, flicks, directionals, slides and longs.
+    :param bpm_changes: number of BPM notes, spread over the chart
+    :param beat_steps: beats between two consecutive notes are picked from these
+    """
+    r = random.Random(seed)
+    length = notes * statistics.mean(beat_steps)
+    chart = [{"type": "BPM", "bpm": 150, "beat": 0}]
+    for i in range(1, bpm_changes):
+        chart.append(
+            {
+                "type": "BPM",
+                "bpm": r.choice([120, 150, 180, 200, 240]),
+                "beat": i * length / bpm_changes,
+            }
+        )
+
+    beat = 1.0
+    for _ in range(notes):
+        beat += r.choice(beat_steps)
+        kind = r.random()
+        if kind < 0.55:
+            note = {"type": "Single", "lane": r.randint(0, 6), "beat": beat}
+            if r.random() < 0.1:
+                note["flick"] = True
+        elif kind < 0.7:
+            note = {
+                "type": "Directional",
+                "lane": r.randint(2, 4),
+                "beat": beat,
+                "direction": r.choice(["Left", "Right"]),
+                "width": r.randint(1, 2),
+            }
+        else:
+            connections = []
+            connection_beat = beat
+            for i in range(r.randint(2, 4)):
+                connection = {"lane": r.randint(0, 6), "beat": connection_beat}
+                if i and r.random() < 0.2:
+                    connection["hidden"] = True
+                connections.append(connection)
+                connection_beat += r.choice([0.5, 1, 2])
+            if r.random() < 0.3:
+                connections[-1]["flick"] = True
+            note = {"type": r.choice(["Slide", "Long"]), "connections": connections}
+        chart.append(note)
+
+    def start_beat(note):
+        return note["beat"] if "beat" in note else note["connections"][0]["beat"]
+
+    chart.sort(key=start_beat)
+    return chart
+
+
+SYNTHETIC_CHARTS = {
+    "synthetic-normal": lambda: generate_chart(600, seed=1),
+    "synthetic-dense": lambda: generate_chart(
+        3000, seed=2, beat_steps=(0, 0.125, 0.25)
+    ),
+    "synthetic-bpm-heavy": lambda: generate_chart(1000, seed=3, bpm_changes=1000),
+}
+
+
+def load_charts(names: list[str] = None, pack: Path = None) -> dict[str, list[dict]]:
+    """Synthetic charts, snapshots in FIXTURES_PATH and charts in pack, by name."""
+    charts = {name: generate for name, generate in SYNTHETIC_CHARTS.items()}
+    for path in sorted(FIXTURES_PATH.glob("*.json")):
+        charts[path.stem] = lambda path=path: json.loads(path.read_text("utf-8"))
+    if pack is not None:
+        chart_pack = ChartPack(pack)
+        for name in chart_pack.names():
+            if name != "allsongs":
+                charts[name] = lambda name=name: chart_pack.get(name)
+    if names:
+        charts = {name: charts[name] for name in names}
+    return {name: generate() for name, generate in charts.items()}
+
+
+def snapshot_chart(song_id: str, difficulty: str) -> Path:
+    """Save a Bestdori chart as a fixture, so it can be benchmarked offline later."""
+    FIXTURES_PATH.mkdir(parents=True, exist_ok=True)
+    path = FIXTURES_PATH / f"{song_id}-{difficulty}.json"
+    path.write_text(
+        json.dumps(BestdoriAPI.get_chart(song_id, difficulty), ensure_ascii=False),
+        "utf-8",
+    )
+    return path
+
+
+def snapshot_hardest(count: int, difficulties=("expert", "special")) -> list[Path]:
+    """
+    Save the `count` charts of the highest play level in the song list as fixtures,
+    so the bench also runs on real charts and not only synthetic ones.
+    """
+    song_list = BestdoriAPI.get_song_list()
+
+    def play_level(chart: tuple[str, str]) -> float:
+        song_id, difficulty = chart
+        index = str(DIFFICULTIES.index(difficulty))
+        return song_list[song_id]["difficulty"][index].get("playLevel", 0)
+
+    charts = sorted(get_jobs(song_list, list(difficulties)), key=play_level)
+    return [snapshot_chart(*chart) for chart in reversed(charts[-count:])]
+
+
+def _loaded_chart(name, chart_data) -> Chart:
+    chart = Chart((name, "bench"), name, copy.deepcopy(chart_data))
+    chart._load_chart()
+    return chart
+
+
+def _compiled_chart(name, chart_data) -> Chart:
+    chart = _loaded_chart(name, chart_data)
+    chart.notes_to_actions(MOVE_SLICE_SIZE, MOVE_TOLERANCE, FRAME_QUANTUM)
+    return chart
+
+
+def _streamed_chart(name, chart_data) -> Chart:
+    chart = _compiled_chart(name, chart_data)
+    chart.compile_stream(SCREEN_RESOLUTION, MNT_RESOLUTION, ORIENTATION)
+    return chart
+
+
+def _play(chart: Chart):
+    while size := chart.next_slice_size(CMD_CHUNK_SIZE):
+        chart.stream_to_MNTcmd(OFFSET, size)
+
+
+# stage: (setup returning the argument, measured function)
+STAGES = {
+    "process_time_chart": (
+        lambda name, data: Chart((name, "bench"), name, copy.deepcopy(data)),
+        lambda chart: chart._load_chart(),
+    ),
+    "notes_to_actions": (
+        _loaded_chart,
+        lambda chart: chart.notes_to_actions(
+            MOVE_SLICE_SIZE, MOVE_TOLERANCE, FRAME_QUANTUM
+        ),
+    ),
+    "compile_stream": (
+        _compiled_chart,
+        lambda chart: chart.compile_stream(
+            SCREEN_RESOLUTION, MNT_RESOLUTION, ORIENTATION
+        ),
+    ),
+    "stream_to_MNTcmd": (_streamed_chart, _play),
+}
+
+
+def measure(setup, function, name, chart_data, repeat: int) -> dict:
+    times = []
+    for _ in range(repeat):
+        argument = setup(name, chart_data)
+        start = time.perf_counter()
+        function(argument)
+        times.append(time.perf_counter() - start)
+
+    # tracemalloc slows everything down, so memory is measured in a run of its own
+    argument = setup(name, chart_data)
+    tracemalloc.start()
+    function(argument)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return {
+        "min": min(times),
+        "median": statistics.median(times),
+        "peak_memory": peak,
+    }
+
+
+def get_commit() -> str:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            cwd=Path(__file__).parent,
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except Exception:
+        return None
+
+
+def run(
+    names: list[str] = None,
+    stages: list[str] = None,
+    repeat: int = 5,
+    pack: Path = None,
+) -> dict:
+    charts = load_charts(names, pack)
+    results = {}
+    for name, chart_data in charts.items():
+        results[name] = {"notes": len(chart_data)}
+        for stage in stages or STAGES:
+            setup, function = STAGES[stage]
+            results[name][stage] = measure(setup, function, name, chart_data, repeat)
+            logging.getLogger("bench").info(
+                "{} {}: {:.2f}ms, {:.0f}KiB peak".format(
+                    name,
+                    stage,
+                    results[name][stage]["median"] * 1000,
+                    results[name][stage]["peak_memory"] / 1024,
+                )
+            )
+    return {
+        "meta": {
+            "commit": get_commit(),
+            "compiler_version": COMPILER_VERSION,
+            "time": time.time(),
+            "python": platform.python_version(),
+            "numpy": np.__version__,
+            "repeat": repeat,
+        },
+        "results": results,
+    }
+
+
+def compare(base: dict, head: dict):
+    """Print the median time and peak memory of head relative to base."""
+    print(f"{base['meta']['commit']} -> {head['meta']['commit']}")
+    for name, stages in head["results"].items():
+        for stage, result in stages.items():
+            if stage == "notes":
+                continue
+            base_result = base["results"].get(name, {}).get(stage)
+            if base_result is None:
+                print(f"{name:24} {stage:20} {result['median'] * 1000:9.2f}ms (new)")
+                continue
+            print(
+                "{:24} {:20} {:9.2f}ms -> {:9.2f}ms ({:+6.1%})  {:8.0f}KiB -> {:8.0f}KiB".format(
+                    name,
+                    stage,
+                    base_result["median"] * 1000,
+                    result["median"] * 1000,
+                    result["median"] / base_result["median"] - 1,
+                    base_result["peak_memory"] / 1024,
+                    result["peak_memory"] / 1024,
+                )
+            )
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Benchmark the chart compilation pipeline offline."
+    )
+    parser.add_argument(
+        "--charts",
+        type=str,
+        nargs="+",
+        help="Specify the charts to run, all synthetic charts and fixtures if not given",
+    )
+    parser.add_argument(
+        "--stages",
+        type=str,
+        nargs="+",
+        choices=list(STAGES),
+        help="Specify the stages to run, all if not given",
+    )
+    parser.add_argument(
+        "--pack",
+        type=Path,
+        help="Specify a chart pack to benchmark the charts of, see autodori export-pack",
+    )
+    parser.add_argument(
+        "--repeat", type=int, default=5, help="Specify the runs of each stage"
+    )
+    parser.add_argument(
+        "--output",
+        type=Path,
+        help="Specify the result file, debug/bench-<commit>.json if not given",
+    )
+    parser.add_argument(
+        "--compare",
+        type=Path,
+        nargs=2,
+        metavar=("BASE", "HEAD"),
+        help="Compare two result files instead of running",
+    )
+    parser.add_argument(
+        "--snapshot",
+        type=str,
+        nargs=2,
+        metavar=("SONG_ID", "DIFFICULTY"),
+        help="Save a Bestdori chart to the fixtures instead of running",
+    )
+    parser.add_argument(
+        "--snapshot-hardest",
+        type=int,
+        metavar="COUNT",
+        help="Save the COUNT expert and special charts of the highest play level to "
+        "the fixtures instead of running",
+    )
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+    # Charts log every dropped note, which would bury the results
+    logging.getLogger().setLevel(logging.ERROR)
+    logging.getLogger("bench").setLevel(logging.INFO)
+
+    if args.compare:
+        base, head = (json.loads(path.read_text("utf-8")) for path in args.compare)
+        compare(base, head)
+        return
+    if args.snapshot:
+        print(snapshot_chart(*args.snapshot))
+        return
+    if args.snapshot_hardest:
+        for path in snapshot_hardest(args.snapshot_hardest):
+            print(path)
+        return
+
+    result = run(args.charts, args.stages, args.repeat, args.pack)
+    output = args.output or Path("debug") / f"bench-{result['meta']['commit']}.json"
+    output.parent.mkdir(parents=True, exist_ok=True)
+    output.write_text(json.dumps(result, indent=2), "utf-8")
+    print(output)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,125 @@
+import logging
+import statistics
+import time
+from statistics import NormalDist
+
+from peewee import *
+
+from chart import PlayRecord
+
+# Half width of the perfect judgement window in ms, hits outside count as fast or slow
+PERFECT_WINDOW = 50
+# Most recent plays of a device the latency is estimated from
+CALIBRATION_PLAYS = 20
+# Plays a device needs before its estimate is used
+MIN_CALIBRATION_PLAYS = 3
+
+
+class PhotogateCalibration(Model):
+    class Meta:
+        database = PlayRecord._meta.database
+
+    device = CharField(unique=True)
+    latency = FloatField()
+    plays = IntegerField()
+    # Mean capture frame interval in ms the latency is for
+    frame_interval = FloatField()
+    updated = TimestampField()
+
+
+PhotogateCalibration.create_table(safe=True)
+
+
+def estimate_bias(result: dict, perfect_window: float = PERFECT_WINDOW) -> float:
+    """
+    Mean timing error of a play in ms, positive when late, from its perfect, fast and
+    slow counts.
+
+    Timing errors are taken as normally distributed, so the share of hits early
+    enough to be fast and late enough to be slow give the mean and the spread.
+    Half a hit is added to both sides, so a play with few fast and slow leans to 0.
+
+    :return: None if the result has no hits or unreadable fields, or every hit is
+        fast or slow, which leaves the spread unknown
+    """
+    try:
+        hits = sum(result[field] for field in ["perfect", "great", "good", "bad"])
+        fast, slow = result["fast"], result["slow"]
+    except (KeyError, TypeError):
+        return None
+    if hits <= 0 or min(fast, slow, result["perfect"]) < 0 or fast + slow >= hits:
+        return None
+
+    normal = NormalDist()
+    fast_z = normal.inv_cdf((fast + 0.5) / (hits + 1))
+    slow_z = normal.inv_cdf(1 - (slow + 0.5) / (hits + 1))
+    sigma = 2 * perfect_window / (slow_z - fast_z)
+    return -perfect_window - sigma * fast_z
+
+
+def calibrate(device: str) -> tuple[float, float]:
+    """
+    Estimate the photogate latency of a device from its recent plays, and store it.
+
+    Every play recorded with the latency it was played with gives an estimate of that
+    latency minus how late it played on average. A note is seen half a frame interval
+    after crossing the band on average, so the estimates are taken from the crossing,
+    adding half the frame interval each play was corrected to, and the latency is for
+    the median frame interval of the plays. Plays captured at different frame rates
+    then estimate the same latency.
+
+    :return: the latency and the frame interval it is for in ms, or None if the device
+        has fewer than MIN_CALIBRATION_PLAYS usable plays
+    """
+    records = (
+        PlayRecord.select()
+        .where(
+            (PlayRecord.device == device)
+            & (PlayRecord.succeed == True)
+            & PlayRecord.photogate.is_null(False)
+        )
+        .order_by(PlayRecord.play_time.desc())
+        .limit(CALIBRATION_PLAYS)
+    )
+    estimates = []
+    frame_intervals = []
+    for record in records:
+        bias = estimate_bias(record.result)
+        if bias is None:
+            continue
+        photogate = record.photogate
+        estimates.append(
+            photogate["latency"] + photogate["reference_interval"] / 2 - bias
+        )
+        frame_intervals.append(photogate["frame_interval"])
+
+    if len(estimates) < MIN_CALIBRATION_PLAYS:
+        return None
+
+    frame_interval = statistics.median(frame_intervals)
+    latency = max(0.0, statistics.median(estimates) - frame_interval / 2)
+    PhotogateCalibration.insert(
+        device=device,
+        latency=latency,
+        plays=len(estimates),
+        frame_interval=frame_interval,
+        updated=int(time.time()),
+    ).on_conflict_replace().execute()
+    logging.getLogger("calibration").debug(
+        f"Photogate latency of {device}: {latency:.1f}ms at {frame_interval:.1f}ms "
+        f"frames from {len(estimates)} plays"
+    )
+    return latency, frame_interval
+
+
+def get_latency(device: str) -> tuple[float, float]:
+    """
+    The stored photogate latency of a device and the frame interval it is for in ms,
+    None if not calibrated yet.
+    """
+    calibration = PhotogateCalibration.get_or_none(
+        PhotogateCalibration.device == device
+    )
+    if calibration is None:
+        return None
+    return calibration.latency, calibration.frame_interval
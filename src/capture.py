@@ -0,0 +1,126 @@
+import logging
+import threading
+import time
+from collections import deque
+from typing import Callable
+
+import numpy as np
+
+
+class CaptureService:
+    """
+    Capture frames on a thread of its own into a ring buffer of `size` preallocated
+    frames, each with the time.perf_counter timestamp of when its capture returned.
+
+    Frames are handed out as views of the ring, so a frame read is overwritten once
+    `size - 1` newer frames have been captured. Copy it to keep it longer.
+    """
+
+    def __init__(
+        self,
+        capture: Callable[[np.ndarray], np.ndarray],
+        shape: tuple[int, ...],
+        size: int = 8,
+        dtype=np.uint8,
+    ):
+        """
+        :param capture: captures a frame into the array it is given, e.g.
+            `lambda out: player.ipc_capture_display(roi, out)`
+        :param shape: shape of every frame
+        """
+        self.capture = capture
+        self.shape = shape
+        self.size = size
+        self._frames = np.empty((size, *shape), dtype=dtype)
+        self._timestamps = np.zeros(size, dtype=np.float64)
+        # Number of frames captured, the newest is at (seq - 1) % size
+        self._seq = 0
+        self._condition = threading.Condition()
+        self._thread: threading.Thread = None
+        self._running = False
+        self._logger = logging.getLogger("capture")
+
+        self.errors = 0
+        self._start_time: float = None
+        # Capture costs of the most recent frames, in seconds
+        self._costs = deque(maxlen=1000)
+
+    def start(self):
+        self._running = True
+        self._start_time = time.perf_counter()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._running = False
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        with self._condition:
+            self._condition.notify_all()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *_):
+        self.stop()
+
+    def _run(self):
+        failing = False
+        while self._running:
+            index = self._seq % self.size
+            start = time.perf_counter()
+            try:
+                self.capture(self._frames[index])
+            except Exception as e:
+                self.errors += 1
+                if not failing:
+                    self._logger.error(f"Failed to get screen: {e}")
+                failing = True
+                continue
+            failing = False
+            end = time.perf_counter()
+            self._timestamps[index] = end
+            self._costs.append(end - start)
+            with self._condition:
+                self._seq += 1
+                self._condition.notify_all()
+
+    def latest(self) -> tuple[int, float, np.ndarray]:
+        """
+        The newest frame without waiting.
+        :return: its sequence number, timestamp and the frame, or None before the first
+        """
+        seq = self._seq
+        if not seq:
+            return None
+        index = (seq - 1) % self.size
+        return seq, float(self._timestamps[index]), self._frames[index]
+
+    def wait_next(
+        self, seq: int = 0, timeout: float = None
+    ) -> tuple[int, float, np.ndarray]:
+        """
+        The newest frame once there is one newer than `seq`, as returned by latest.
+        None if timed out or stopped.
+        """
+        with self._condition:
+            if not self._condition.wait_for(
+                lambda: self._seq > seq or not self._running, timeout
+            ):
+                return None
+        if self._seq <= seq:
+            return None
+        return self.latest()
+
+    def stats(self) -> dict:
+        elapsed = time.perf_counter() - self._start_time if self._start_time else 0
+        costs = np.array(self._costs.copy()) * 1000
+        return {
+            "frames": self._seq,
+            "errors": self.errors,
+            "fps": self._seq / elapsed if elapsed else None,
+            "capture": float(costs.mean()) if costs.size else None,
+            "capture_p95": float(np.percentile(costs, 95)) if costs.size else None,
+        }
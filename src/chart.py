@@ -1,15 +1,28 @@
-import json
 import logging
+import math
 import time
 from pathlib import Path
 
-from minitouchpy import CommandBuilder
+import numpy as np
 from peewee import *
+from playhouse.migrate import SqliteMigrator, migrate
 from playhouse.sqlite_ext import JSONField
 
 import util
 from api import BestdoriAPI
-import yaml
+from allocator import FingerAllocator
+from chartcache import CompiledChartCache
+from stream import CommandStream
+from tempo import TempoMap
+from timeline import MOVE, ActionTimeline, ActionTimelineBuilder
+from tracefile import TraceWriter
+
+# Bump when notes_to_actions output changes, so compiled charts in the cache are rebuilt
+COMPILER_VERSION = 4
+# Flick distance in normalized screen height (300px at 1280x720)
+FLICK_HEIGHT = 300 / 720
+
+Path("data").mkdir(exist_ok=True)
 
 
 class PlayRecord(Model):
@@ -22,52 +35,93 @@ class PlayRecord(Model):
     difficulty = CharField()
     succeed = BooleanField()
     result = JSONField()
+    device = CharField(null=True)
+    photogate = JSONField(null=True)
 
 
 PlayRecord.create_table(safe=True)
+_play_record_columns = {
+    column.name
+    for column in PlayRecord._meta.database.get_columns(PlayRecord._meta.table_name)
+}
+migrate(
+    *[
+        SqliteMigrator(PlayRecord._meta.database).add_column(
+            PlayRecord._meta.table_name, field.column_name, field
+        )
+        for field in [PlayRecord.device, PlayRecord.photogate]
+        if field.column_name not in _play_record_columns
+    ]
+)
 
 
 class Chart:
-    def __init__(self, id_and_difficulty: tuple[str, str] = None, song_name=None):
+    def __init__(
+        self,
+        id_and_difficulty: tuple[str, str] = None,
+        song_name=None,
+        chart_data: list[dict] = None,
+    ):
+        """
+        :param chart_data: Bestdori chart to use instead of fetching it, e.g. an offline
+            fixture. It is annotated in place when loaded.
+        """
         self._id_, self._difficulty = id_and_difficulty
         self._song_name = song_name
         self._chart_name = f"{self._id_}-{self._difficulty}"
-        self._chart_data = BestdoriAPI.get_chart(self._id_, self._difficulty)
+        self._raw_chart_data = chart_data
+        self._chart_data: list[dict] = None
         self._logger = logging.getLogger(self._chart_name)
         self._bpms = []
-        self.actions = []
-        self._commands = []
-        self._total = len(self._chart_data)
-        self._process_time_chart()
-
-        self.actions_to_cmd_index = 0
+        self._tempo_map: TempoMap = None
+        self.finger_stats = {}
+        self.actions = ActionTimeline()
+        self.stream: CommandStream = None
+        self.trace: TraceWriter = None
+        self._cache_key: str = None
+        self._total = 0
+        self._note_count = 0
+
+        self.stream_index = 0
         self._a2c_offset = 0
         self._a2c_rounded_loss = 0.0
+        # Command costs estimated from offset_info so far, in ms
+        self._a2c_budget = 0.0
 
-    def _beat_to_time(self, beat: float) -> float:
-        if not self._bpms:
-            return 0
-
-        def _get_time_for_section(
-            bpm: float, previous_bpm_beat: float, current_bpm_beat: float
-        ) -> float:
-            return (current_bpm_beat - previous_bpm_beat) * (60.0 / bpm) if bpm else 0
-
-        time_ = 0.0
-
-        previous_bpm_beat = 0.0
-        current_bpm = 0.0
-
-        for bpm, bpm_beat in self._bpms:
-            if bpm_beat > beat:
-                break
-            time_ += _get_time_for_section(current_bpm, previous_bpm_beat, bpm_beat)
-            previous_bpm_beat = bpm_beat
-            current_bpm = bpm
-
-        time_ += _get_time_for_section(current_bpm, previous_bpm_beat, beat)
+    def _load_chart(self):
+        if self._chart_data is None:
+            if self._raw_chart_data is not None:
+                self._chart_data = self._raw_chart_data
+            else:
+                # The cached chart is shared, annotate copies of its notes
+                self._chart_data = [
+                    (
+                        {**note, "connections": [dict(c) for c in note["connections"]]}
+                        if "connections" in note
+                        else dict(note)
+                    )
+                    for note in BestdoriAPI.get_chart(self._id_, self._difficulty)
+                ]
+            self._total = len(self._chart_data)
+            self._process_time_chart()
+
+    def get_note_count(self) -> int:
+        """Judged notes: every single, directional and visible slide or long connection."""
+        self._load_chart()
+        return self._note_count
+
+    def get_note_times(self) -> np.ndarray:
+        """Sorted judgement times in ms of the notes counted by get_note_count."""
+        self._load_chart()
+        times = []
+        for note in self._chart_data:
+            for item in note.get("connections", [note]):
+                if "checkpoint_index" in item:
+                    times.append(item["time"])
+        return np.sort(np.array(times, dtype=np.float64))
 
-        return time_ * 1000
+    def _beat_to_time(self, beat: float) -> float:
+        return self._tempo_map.beat_to_time(beat)
 
     def _process_time_chart(self):
         checkpoint_index = -1
@@ -83,6 +137,7 @@ class Chart:
             note_index += 1
             return note_index
 
+        timed = []
         for _, note in enumerate(self._chart_data):
             note_type = note["type"]
 
@@ -91,89 +146,74 @@ class Chart:
                 beat = note["beat"]
                 self._bpms.append((bpm, beat))
             elif note_type in ["Single", "Directional"]:
-                note["time"] = self._beat_to_time(note["beat"])
+                timed.append(note)
                 note["checkpoint_index"] = get_checkpoint_index()
                 note["index"] = get_note_index()
             elif note_type in ["Slide", "Long"]:
                 note["index"] = get_note_index()
                 for connection in note["connections"]:
-                    connection["time"] = self._beat_to_time(connection["beat"])
+                    timed.append(connection)
                     if not connection.get("hidden", False):
                         connection["checkpoint_index"] = get_checkpoint_index()
             else:
                 self._logger.warning(
                     f"_chart_to_time_chart: Unknown type: {note_type}, Skipped"
                 )
+
+        self._note_count = checkpoint_index + 1
+        self._tempo_map = TempoMap(self._bpms)
+        times = self._tempo_map.beats_to_times([item["beat"] for item in timed])
+        for item, time_ in zip(timed, times.tolist()):
+            item["time"] = time_
+
         self._logger.debug(
             f"_chart_to_time_chart: Succeed: {len(self._chart_data)} notes"
         )
 
     def notes_to_actions(
-        self,
-        screen_resolution: tuple[int, int],
-        default_move_slice_size,
+        self, default_move_slice_size, move_tolerance=None, frame_quantum=0.001
     ):
+        """
+        :param default_move_slice_size: shortest interval between two moves, in ms
+        :param move_tolerance: largest position error allowed between two moves, in
+            reference pixels. None emits a move every default_move_slice_size ms.
+        :param frame_quantum: actions less than this many ms apart share a commit
+        """
+        self._load_chart()
         notes: list[dict] = self._chart_data
+        get_lane_position = util.get_normalized_lane_position
 
-        def get_lane_position(lane: int) -> tuple[int, int]:
-            lane_config = util.get_runtime_info(screen_resolution)["lane"]
-            return (
-                lane_config["start_x"] + (lane + 0.5) * lane_config["w"],
-                lane_config["h"],
-            )
+        actions = ActionTimelineBuilder()
 
-        actions = []
-        available_fingers = [
-            {
-                "id": i,
-                "occupied_time": [],
-            }
-            for i in range(1, 6)
-        ]
-
-        def get_finger(from_time, to_time) -> int:
-            for finger in available_fingers:
-                if any(
-                    not (to_time <= occupied_from or from_time >= occupied_to)
-                    for occupied_from, occupied_to in finger["occupied_time"]
-                ):
-                    continue
-                else:
-                    finger["occupied_time"].append((from_time, to_time))
-                    return finger["id"]
+        def get_finger_interval(note_data) -> tuple[float, float]:
+            note_type = note_data["type"]
+            if note_type == "Single":
+                time_ = note_data["time"]
+                return (time_, time_ + (80 if note_data.get("flick") else 50))
+            elif note_type == "Directional":
+                time_ = note_data["time"]
+                return (time_, time_ + 80)
+            elif note_type in ["Long", "Slide"]:
+                from_time = note_data["connections"][0]["time"]
+                to_time = note_data["connections"][-1]["time"]
+                if note_data["connections"][-1].get("flick"):
+                    return (from_time, to_time + 80)
+                return (from_time, to_time)
             return None
 
-        def add_tap(note_index, from_time, duration, pos):
-            finger = get_finger(from_time, from_time + duration)
-            actions.extend(
-                [
-                    {
-                        "finger": finger,
-                        "type": "down",
-                        "time": from_time,
-                        "pos": pos,
-                        "note": note_index,
-                    },
-                    {
-                        "finger": finger,
-                        "type": "up",
-                        "time": from_time + duration,
-                        "note": note_index,
-                    },
-                ]
+        allocator = FingerAllocator()
+        intervals = [get_finger_interval(note) for note in notes]
+        fingers = allocator.allocate(intervals)
+        self.finger_stats = allocator.stats()
+        self._logger.debug(f"notes_to_actions: Finger stats: {self.finger_stats}")
+        for i in allocator.dropped:
+            self._logger.warning(
+                f"notes_to_actions: No finger available for note {notes[i].get('index')} at {intervals[i]}, Dropped"
             )
 
-        def split_number(num, part_size):
-            result = []
-            cur = 0
-            while True:
-                if num - cur > part_size:
-                    result.append((cur, part_size))
-                    cur += part_size
-                else:
-                    result.append((cur, num - cur))
-                    break
-            return result
+        def add_tap(note_index, finger, from_time, duration, pos):
+            actions.down(finger, from_time, pos, note_index)
+            actions.up(finger, from_time + duration, note_index)
 
         def add_smooth_move(
             note_index,
@@ -189,62 +229,58 @@ class Chart:
             to_time = from_time + duration
             from_x, from_y = from_
             to_x, to_y = to
-            slices = split_number(duration, slice_size)
-            x_size = (to_x - from_x) / duration
-            y_size = (to_y - from_y) / duration
+            reference_x, reference_y = util.REFERENCE_RESOLUTION
+            slices = util.get_move_slices(
+                duration,
+                math.hypot(
+                    (to_x - from_x) * reference_x, (to_y - from_y) * reference_y
+                ),
+                slice_size,
+                move_tolerance,
+            )
 
-            result = []
             if down:
-                result.append(
-                    {
-                        "finger": finger,
-                        "type": "down",
-                        "time": from_time,
-                        "pos": from_,
-                        "note": note_index,
-                    }
-                )
+                actions.down(finger, from_time, from_, note_index)
             for i, (cur_slice_start, cur_slice_size) in enumerate(slices):
-                result.append(
-                    {
-                        "finger": finger,
-                        "type": "move",
-                        "time": 0.00001 + from_time + cur_slice_start,
-                        "to": (
-                            from_x + x_size * (cur_slice_size + cur_slice_start),
-                            from_y + y_size * (cur_slice_size + cur_slice_start),
-                        ),
-                        "note": note_index,
-                    }
+                progress = (
+                    (cur_slice_start + cur_slice_size) / duration if duration else 1
                 )
-            if up:
-                result.append(
-                    {
-                        "finger": finger,
-                        "type": "up",
-                        "time": to_time,
-                        "note": note_index,
-                    },
+                actions.move(
+                    finger,
+                    0.00001 + from_time + cur_slice_start,
+                    (
+                        from_x + (to_x - from_x) * progress,
+                        from_y + (to_y - from_y) * progress,
+                    ),
+                    note_index,
                 )
-            actions.extend(result)
+            if up:
+                actions.up(finger, to_time, note_index)
 
-        for note in notes:
+        for note, interval, finger in zip(notes, intervals, fingers):
             note_data = note
             note_type = note_data["type"]
             note_index = note_data.get("index", None)
 
+            if interval is not None and finger is None:
+                continue
+
             if note_type == "Single":
                 time_ = note_data["time"]
                 from_lane = note_data["lane"]
                 pos = get_lane_position(from_lane)
 
                 if note_data.get("flick"):
-                    finger = get_finger(time_, time_ + 80)
                     add_smooth_move(
-                        note_index, finger, time_, 80, pos, (pos[0], pos[1] - 300)
+                        note_index,
+                        finger,
+                        time_,
+                        80,
+                        pos,
+                        (pos[0], pos[1] - FLICK_HEIGHT),
                     )
                 else:
-                    add_tap(note_index, time_, 50, pos)
+                    add_tap(note_index, finger, time_, 50, pos)
 
             elif note_type == "Directional":
                 time_ = note_data["time"]
@@ -255,7 +291,6 @@ class Chart:
                     tolane = fromlane + width
                 else:
                     tolane = fromlane - width
-                finger = get_finger(time_, time_ + 80)
 
                 add_smooth_move(
                     note_index,
@@ -276,19 +311,7 @@ class Chart:
                     finger_end_time = to_time + 80
                 else:
                     finger_end_time = to_time
-                finger = get_finger(
-                    from_time,
-                    finger_end_time,
-                )
-                actions.append(
-                    {
-                        "finger": finger,
-                        "type": "down",
-                        "time": from_time,
-                        "pos": from_pos,
-                        "note": note_index,
-                    }
-                )
+                actions.down(finger, from_time, from_pos, note_index)
 
                 end_pos = None
 
@@ -316,160 +339,172 @@ class Chart:
                         to_time,
                         80,
                         end_pos,
-                        (end_pos[0], end_pos[1] - 300),
+                        (end_pos[0], end_pos[1] - FLICK_HEIGHT),
                         down=False,
                         up=False,
                     )
-                actions.append(
-                    {
-                        "finger": finger,
-                        "type": "up",
-                        "time": finger_end_time,
-                        "note": note_index,
-                    }
-                )
+                actions.up(finger, finger_end_time, note_index)
             else:
                 logging.warning(f"notes_to_actions: Unknown type: {note_type}")
 
-        actions.sort(key=lambda x: x["time"])
-        actions: list[dict]
-
-        actions_with_wait: list[dict] = []
-        for i, action in enumerate(actions):
-            actions_with_wait.append(action)
-            if i != len(actions) - 1:
-                current_time = action["time"]
-                next_time = actions[i + 1]["time"]
-
-                if next_time - current_time > 0.001:
-                    actions_with_wait.append(
-                        {
-                            "type": "wait",
-                            "time": current_time,
-                            "length": next_time - current_time,
-                        }
-                    )
-            else:
-                pass
-
-        [
-            action.setdefault("index", index)
-            for index, action in enumerate(actions_with_wait)
-        ]
-        self.actions = actions_with_wait
-
-    def actions_to_MNTcmd(self, resolution, orientation, offset_info, size=50):
-        self.command_builder = CommandBuilder()
-        builder = self.command_builder
-        actions = self.actions[
-            self.actions_to_cmd_index : self.actions_to_cmd_index + size
-        ]
-        commands = self._commands
-
-        up_offset = offset_info.get("up", 0)
-        down_offset = offset_info.get("down", 0)
-        move_offset = offset_info.get("move", 0)
-        wait_offset = offset_info.get("wait", 0)
-        interval_offset = offset_info.get("interval", 0)
+        self.actions = actions.build(frame_quantum)
+        self._logger.debug(
+            f"notes_to_actions: Succeed: {len(self.actions)} actions, {int((self.actions.array['type'] == MOVE).sum())} moves"
+        )
 
-        def append(command_to_append, action=None):
-            commands.append(
-                {
-                    "command": command_to_append,
-                    "action": action,
-                }
+    def load_actions(
+        self, default_move_slice_size, move_tolerance=None, frame_quantum=0.001
+    ):
+        key = self._cache_key = CompiledChartCache.make_key(
+            self._id_,
+            self._difficulty,
+            default_move_slice_size,
+            move_tolerance,
+            frame_quantum,
+            COMPILER_VERSION,
+        )
+        actions = CompiledChartCache.get(key)
+        if actions is None:
+            self.notes_to_actions(
+                default_move_slice_size, move_tolerance, frame_quantum
             )
+            CompiledChartCache.set(key, self.actions)
+        else:
+            self.actions = actions
+
+    def compile_stream(self, screen_resolution, mnt_resolution, orientation):
+        key = None
+        if self._cache_key is not None:
+            key = "-".join(
+                [
+                    self._cache_key,
+                    util.resolution_to_xformat(screen_resolution),
+                    util.resolution_to_xformat(mnt_resolution),
+                    str(orientation),
+                ]
+            )
+            self.stream = CompiledChartCache.get(key, CommandStream)
+            if self.stream is not None:
+                return
 
-        def round_tuple(target):
-            return tuple(round(x) for x in target)
+        positions = util.normalizedxy_to_MNTxy(
+            self.actions.points(),
+            util.get_MNT_transform(screen_resolution, mnt_resolution, orientation),
+        )
+        self.stream = CommandStream.compile(self.actions, positions)
+        self._logger.debug(
+            f"compile_stream: Succeed: {len(self.stream)} frames, {len(self.stream.data)} bytes"
+        )
+        if key is not None:
+            CompiledChartCache.set(key, self.stream)
+
+    def _adjust_wait(self, wait_for: float) -> int:
+        OFFSET_LIMIT = 1
+        offset_adjust = min(
+            wait_for,
+            min(OFFSET_LIMIT, max(-OFFSET_LIMIT, self._a2c_offset)),
+        )
+        wait_for -= offset_adjust
+        self._a2c_offset -= offset_adjust
 
-        # append
-        for i, action in enumerate(actions):
-            action_type = action["type"]
-            action_index = action["index"]
+        LOSS_LIMIT = 2
+        rounded_loss_adjust = min(
+            wait_for,
+            min(LOSS_LIMIT, max(-LOSS_LIMIT, self._a2c_rounded_loss)),
+        )
+        wait_for -= rounded_loss_adjust
+        self._a2c_rounded_loss -= rounded_loss_adjust
 
-            self._a2c_offset += interval_offset
+        rounded_waitfor = round(wait_for)
+        self._a2c_rounded_loss -= wait_for - rounded_waitfor
+        return rounded_waitfor
 
-            if action_type == "down":
-                self._a2c_offset += down_offset
-                finger = action["finger"]
-                append(
-                    builder.down(
-                        finger,
-                        *util.androidxy_to_MNTxy(
-                            round_tuple(action["pos"]), resolution, orientation
-                        ),
-                        1,
-                    ),
-                    action_index,
-                )
-            elif action_type == "move":
-                self._a2c_offset += move_offset
-                finger = action["finger"]
-                append(
-                    builder.move(
-                        finger,
-                        *util.androidxy_to_MNTxy(
-                            round_tuple(action["to"]), resolution, orientation
-                        ),
-                        1,
-                    ),
-                    action_index,
-                )
+    def stream_to_MNTcmd(self, offset_info, size=50) -> tuple[list, int]:
+        """
+        Take the next `size` frames of the compiled stream.
 
-            elif action_type == "up":
-                self._a2c_offset += up_offset
-                finger = action["finger"]
-                append(builder.up(finger), action_index)
+        :return: byte segments to write to minitouch in order, and the total wait in ms
+        """
+        stream = self.stream
+        start = self.stream_index
+        stop = min(start + size, len(stream))
 
-            elif action_type == "wait":
-                self._a2c_offset += wait_offset
-                wait_for = action["length"]
+        up_offset = offset_info.get("up", 0)
+        down_offset = offset_info.get("down", 0)
+        move_offset = offset_info.get("move", 0)
+        wait_offset = offset_info.get("wait", 0)
+        interval_offset = offset_info.get("interval", 0)
 
-                OFFSET_LIMIT = 1
-                offset_adjust = min(
-                    wait_for,
-                    min(OFFSET_LIMIT, max(-OFFSET_LIMIT, self._a2c_offset)),
-                )
-                # self._logger.debug(
-                #    f"self._a2c_offset: {self._a2c_offset}, wait_for: {wait_for}, adjust: {offset_adjust}"
-                # )
-                wait_for -= offset_adjust
-                self._a2c_offset -= offset_adjust
-
-                LOSS_LIMIT = 2
-                rounded_loss_adjust = min(
-                    wait_for,
-                    min(LOSS_LIMIT, max(-LOSS_LIMIT, self._a2c_rounded_loss)),
-                )
-                wait_for -= rounded_loss_adjust
-                self._a2c_rounded_loss -= rounded_loss_adjust
-
-                rounded_waitfor = round(wait_for)
-                self._a2c_rounded_loss -= wait_for - rounded_waitfor
-                if rounded_waitfor > 0.01:
-                    append(builder.commit())
-                    append(builder.wait(rounded_waitfor))
-
-        self.actions_to_cmd_index += size
-
-    def dump_debug_config(self):
-        dump_path = Path("debug/dump")
-        dump_path.mkdir(parents=True, exist_ok=True)
-        (
-            dump_path / f"{self._song_name}-{self._difficulty}-{time.time()}.yml"
-        ).write_text(
-            yaml.safe_dump(
-                {
-                    "song_name": self._song_name,
-                    "song_id": self._id_,
-                    "chart": self._chart_data,
-                    "actions": self.actions,
-                    "commands": self._commands,
-                },
-                sort_keys=False,
-                allow_unicode=True,
-                indent=2,
-            ),
-            "utf-8",
+        segments = []
+        slice_wait = 0
+        segment_start = stream.start_of(start)
+        for frame in range(start, stop):
+            downs, moves, ups = stream.counts[frame].tolist()
+            budget = (
+                (downs + moves + ups) * interval_offset
+                + downs * down_offset
+                + moves * move_offset
+                + ups * up_offset
+            )
+
+            wait_for = float(stream.waits[frame])
+            if wait_for:
+                budget += interval_offset + wait_offset
+            self._a2c_offset += budget
+            self._a2c_budget += budget
+            if not wait_for:
+                continue
+            rounded_waitfor = self._adjust_wait(wait_for)
+            if rounded_waitfor > 0.01:
+                segment_end = int(stream.ends[frame])
+                segments.append(stream.view[segment_start:segment_end])
+                segments.append(b"w %d\n" % rounded_waitfor)
+                segment_start = segment_end
+                slice_wait += rounded_waitfor
+
+        segment_end = stream.start_of(stop)
+        if segment_end > segment_start:
+            segments.append(stream.view[segment_start:segment_end])
+
+        self.stream_index = stop
+        return segments, slice_wait
+
+    def next_slice_size(self, duration: float) -> int:
+        """Number of frames from stream_index that span duration ms of chart time."""
+        if self.stream_index >= len(self.stream):
+            return 0
+        start_time = self.stream.times[self.stream_index]
+        return max(1, self.stream.search(start_time + duration) - self.stream_index)
+
+    def dump_debug_config(self) -> TraceWriter:
+        """
+        Start a trace of this chart in debug/dump with the chart, actions and command
+        stream. It stays open as self.trace, so playback can append to it, until
+        close_trace is called.
+        """
+        self._load_chart()
+        self.close_trace()
+        self.trace = TraceWriter(
+            Path("debug/dump")
+            / f"{self._song_name}-{self._difficulty}-{time.time()}.trace"
+        )
+        self.trace.write_json(
+            "meta",
+            {
+                "song_name": self._song_name,
+                "song_id": self._id_,
+                "difficulty": self._difficulty,
+                "compiler_version": COMPILER_VERSION,
+            },
         )
+        self.trace.write_json("chart", self._chart_data)
+        self.trace.write_actions(self.actions)
+        if self.stream:
+            self.trace.write_stream(self.stream)
+        self._logger.info(f"Tracing to {self.trace.path}")
+        return self.trace
+
+    def close_trace(self):
+        if self.trace:
+            self.trace.close()
+            self.trace = None
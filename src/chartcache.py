@@ -0,0 +1,70 @@
+import logging
+
+from diskcache import Cache
+
+from timeline import ActionTimeline
+
+
+class CompiledChartCache:
+    """Compiled action timelines, stored next to the BestdoriAPI cache."""
+
+    _logger = logging.getLogger("CompiledChartCache")
+    _cache = Cache(
+        "cache/compiled",
+        eviction_policy="least-recently-used",
+        size_limit=256 * 1024 * 1024,
+    )
+    hits = 0
+    misses = 0
+
+    @staticmethod
+    def make_key(
+        chart_id,
+        difficulty,
+        move_slice_size,
+        move_tolerance,
+        frame_quantum,
+        compiler_version: int,
+    ) -> str:
+        # Actions are in normalized coordinates, so neither the resolution nor the
+        # orientation of the device is part of the key
+        return "-".join(
+            str(part)
+            for part in [
+                chart_id,
+                difficulty,
+                move_slice_size,
+                move_tolerance,
+                frame_quantum,
+                f"v{compiler_version}",
+            ]
+        )
+
+    @staticmethod
+    def get(key, type_=ActionTimeline):
+        """
+        :param type_: class with a from_bytes staticmethod, e.g. ActionTimeline or CommandStream
+        """
+        data = CompiledChartCache._cache.get(key)
+        if data is None:
+            CompiledChartCache.misses += 1
+            CompiledChartCache._logger.info(f"Cache miss for {key}")
+            return None
+        CompiledChartCache.hits += 1
+        CompiledChartCache._logger.info(f"Cache hit for {key}")
+        return type_.from_bytes(data)
+
+    @staticmethod
+    def set(key, value):
+        data = value.to_bytes()
+        CompiledChartCache._cache.set(key, data)
+        CompiledChartCache._logger.info(f"Cache set for {key}: {len(data)} bytes")
+
+    @staticmethod
+    def stats() -> dict:
+        return {
+            "hits": CompiledChartCache.hits,
+            "misses": CompiledChartCache.misses,
+            "entries": len(CompiledChartCache._cache),
+            "size": CompiledChartCache._cache.volume(),
+        }
@@ -0,0 +1,88 @@
+import json
+import mmap
+import struct
+import time
+import zlib
+from pathlib import Path
+
+MAGIC = b"ADPACK1\0"
+# magic, index offset, index length
+HEADER = struct.Struct("<8sQQ")
+
+
+class ChartPackWriter:
+    """
+    Write a chart pack: a header, then every entry as zlib-compressed JSON, then an
+    index of {name: (offset, length)} in the same form.
+
+    Entries are JSON and not pickle so a pack can be shared without trusting it.
+    """
+
+    def __init__(self, path: Path):
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._file = open(self.path, "wb")
+        self._file.write(HEADER.pack(MAGIC, 0, 0))
+        self._index: dict[str, tuple[int, int]] = {}
+
+    def add(self, name: str, value):
+        data = zlib.compress(json.dumps(value, ensure_ascii=False).encode())
+        self._index[name] = (self._file.tell(), len(data))
+        self._file.write(data)
+
+    def close(self):
+        index = zlib.compress(
+            json.dumps({"created": time.time(), "entries": self._index}).encode()
+        )
+        index_offset = self._file.tell()
+        self._file.write(index)
+        self._file.seek(0)
+        self._file.write(HEADER.pack(MAGIC, index_offset, len(index)))
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_):
+        self.close()
+
+
+class ChartPack:
+    """
+    Read-only chart pack, memory-mapped so only the entries asked for are read.
+    Entry names are the BestdoriAPI cache names, e.g. "allsongs" or "128-expert".
+    """
+
+    def __init__(self, path: Path):
+        self.path = Path(path)
+        self._file = open(self.path, "rb")
+        self._mmap = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, index_offset, index_length = HEADER.unpack_from(self._mmap)
+        if magic != MAGIC or not index_offset:
+            self.close()
+            raise ValueError(f"{self.path} is not a chart pack")
+        index = json.loads(
+            zlib.decompress(self._mmap[index_offset : index_offset + index_length])
+        )
+        self.created: float = index["created"]
+        self._index: dict[str, list[int]] = index["entries"]
+
+    def __len__(self):
+        return len(self._index)
+
+    def __contains__(self, name):
+        return name in self._index
+
+    def names(self) -> list[str]:
+        return list(self._index)
+
+    def get(self, name):
+        """The entry, or None if the pack does not have it."""
+        if (entry := self._index.get(name)) is None:
+            return None
+        offset, length = entry
+        return json.loads(zlib.decompress(self._mmap[offset : offset + length]))
+
+    def close(self):
+        self._mmap.close()
+        self._file.close()
@@ -0,0 +1,120 @@
+import heapq
+import threading
+import unicodedata
+from collections import Counter, OrderedDict
+
+from fuzzywuzzy import fuzz
+
+
+class SongMatcher:
+    """
+    Fuzzy match OCR text to song titles.
+
+    Titles are normalized once and indexed by character n-gram, so a match only
+    scores the `candidates` titles sharing the most n-grams with the text instead
+    of every title. Results are memoized by raw text, since the same song name is
+    read again on every frame while it is on screen.
+    """
+
+    def __init__(self, titles=(), ngram=2, candidates=32, memo_size=1024):
+        self.ngram = ngram
+        self.candidates = candidates
+        self.memo_size = memo_size
+        self.hits = 0
+        self.misses = 0
+        # One slot per title ever added, None once removed
+        self._titles: list[str] = []
+        self._keys: list[str] = []
+        self._grams: list[set[str]] = []
+        self._slots: dict[str, int] = {}
+        self._index: dict[str, set[int]] = {}
+        self._memo: OrderedDict[str, tuple[str, int]] = OrderedDict()
+        self._lock = threading.Lock()
+        for title in titles:
+            self.add(title)
+
+    def __len__(self):
+        return len(self._slots)
+
+    @staticmethod
+    def normalize(text: str) -> str:
+        """NFKC and casefold, with anything but letters and digits as single spaces."""
+        text = unicodedata.normalize("NFKC", text).casefold()
+        return " ".join("".join(c if c.isalnum() else " " for c in text).split())
+
+    def _get_grams(self, key: str) -> set[str]:
+        compact = key.replace(" ", "")
+        if len(compact) < self.ngram:
+            return {compact} if compact else set()
+        return {
+            compact[i : i + self.ngram] for i in range(len(compact) - self.ngram + 1)
+        }
+
+    def add(self, title: str):
+        with self._lock:
+            if title in self._slots:
+                return
+            slot = len(self._titles)
+            key = self.normalize(title)
+            grams = self._get_grams(key)
+            self._titles.append(title)
+            self._keys.append(key)
+            self._grams.append(grams)
+            self._slots[title] = slot
+            for gram in grams:
+                self._index.setdefault(gram, set()).add(slot)
+            self._memo.clear()
+
+    def remove(self, title: str):
+        with self._lock:
+            slot = self._slots.pop(title, None)
+            if slot is None:
+                return
+            for gram in self._grams[slot]:
+                self._index[gram].discard(slot)
+            self._titles[slot] = None
+            self._memo.clear()
+
+    @staticmethod
+    def score(key: str, other: str) -> int:
+        """WRatio of two normalized keys, keeping non-ASCII."""
+        return fuzz.WRatio(key, other, force_ascii=False, full_process=False)
+
+    def match(self, text: str) -> tuple[str, int]:
+        """
+        :return: best matching title and its score from 0 to 100, or (None, 0) if no
+            title shares an n-gram with the text
+        """
+        with self._lock:
+            if (result := self._memo.get(text)) is not None:
+                self._memo.move_to_end(text)
+                self.hits += 1
+                return result
+            self.misses += 1
+
+            result = self._match(text)
+            self._memo[text] = result
+            if len(self._memo) > self.memo_size:
+                self._memo.popitem(last=False)
+            return result
+
+    def _match(self, text: str) -> tuple[str, int]:
+        key = self.normalize(text)
+        grams = self._get_grams(key)
+        overlaps = Counter()
+        for gram in grams:
+            overlaps.update(self._index.get(gram, ()))
+        if not overlaps:
+            return None, 0
+
+        candidates = heapq.nlargest(
+            self.candidates,
+            overlaps,
+            key=lambda slot: overlaps[slot] / (len(grams) + len(self._grams[slot])),
+        )
+        scores = {slot: self.score(key, self._keys[slot]) for slot in candidates}
+        best = max(candidates, key=scores.__getitem__)
+        return self._titles[best], scores[best]
+
+    def stats(self) -> dict:
+        return {"titles": len(self), "hits": self.hits, "misses": self.misses}
@@ -0,0 +1,146 @@
+import logging
+import statistics
+import time
+from typing import Callable, Union
+
+import numpy as np
+
+
+def band_color(
+    frame: np.ndarray, from_row: int, to_row: int, row_step: int = 1, col_step: int = 4
+) -> np.ndarray:
+    """Mean (R, G, B) of every `row_step`-th row and `col_step`-th column of a band."""
+    band = frame[from_row : to_row + 1 : row_step, ::col_step, :3]
+    return band.mean(axis=(0, 1), dtype=np.float32)
+
+
+class Photogate:
+    """
+    Detect the first note by watching a band of rows across the lanes.
+
+    The screen has to stay still for `freeze_time` ms of frames first, then the first
+    frame whose band gets brighter by more than `threshold` trips the gate. Only the
+    band is reduced, every `row_step`-th row and `col_step`-th column of it, to its
+    mean color in one numpy call.
+
+    Frames are timestamped with time.perf_counter when the capture returns, so
+    `latency` of the result is how long it took from the tripping frame to the gate
+    reporting it.
+    """
+
+    def __init__(
+        self,
+        capture: Callable[[], Union[np.ndarray, tuple[float, np.ndarray]]],
+        from_row: int,
+        to_row: int,
+        row_step: int = 1,
+        col_step: int = 4,
+        threshold: float = 3,
+        freeze_time: float = 3000,
+    ):
+        """
+        :param capture: returns a (height, width, 3) frame, or just the band when
+            from_row is 0 and to_row is its last row. It may return the frame with its
+            own perf_counter timestamp as (timestamp, frame), e.g. from CaptureService.
+        :param freeze_time: ms the band has to stay still for, summed over the
+            intervals of frames that did not change, so it does not depend on the
+            frame rate
+        """
+        self.capture = capture
+        self.from_row = from_row
+        self.to_row = to_row
+        self.row_step = row_step
+        self.col_step = col_step
+        self.threshold = threshold
+        self.freeze_time = freeze_time
+        self._logger = logging.getLogger("photogate")
+        self.frames = 0
+        self.errors = 0
+        self._frame_times: list[float] = []
+        self._capture_costs: list[float] = []
+        self._reduce_costs: list[float] = []
+
+    def band_color(self, frame: np.ndarray) -> np.ndarray:
+        """Mean (R, G, B) of the band."""
+        return band_color(
+            frame, self.from_row, self.to_row, self.row_step, self.col_step
+        )
+
+    def wait(self, timeout: float = None) -> dict:
+        """
+        Block until the gate trips.
+        :param timeout: seconds to give up after, never if None
+        :return: timestamp of the tripping frame and of the detection in
+            time.perf_counter seconds, their difference as latency in ms, and the frame
+            interval in ms the note may have crossed the band anywhere within. None if
+            timed out.
+        """
+        last_color = None
+        still_time = 0.0
+        frozen = False
+        last_frame_time = None
+        start = time.perf_counter()
+
+        while timeout is None or time.perf_counter() - start < timeout:
+            capture_start = time.perf_counter()
+            try:
+                frame = self.capture()
+            except Exception as e:
+                self.errors += 1
+                self._logger.error(f"Failed to get screen: {e}")
+                continue
+            received_time = frame_time = time.perf_counter()
+            if isinstance(frame, tuple):
+                frame_time, frame = frame
+            color = self.band_color(frame)
+            reduced_time = time.perf_counter()
+
+            self.frames += 1
+            self._capture_costs.append(received_time - capture_start)
+            self._reduce_costs.append(reduced_time - received_time)
+            if last_frame_time is not None:
+                self._frame_times.append(frame_time - last_frame_time)
+
+            if last_color is not None:
+                change = float(np.sum(color - last_color))
+                if change > self.threshold:
+                    if frozen:
+                        detect_time = time.perf_counter()
+                        result = {
+                            "frame_time": frame_time,
+                            "detect_time": detect_time,
+                            "latency": (detect_time - frame_time) * 1000,
+                            "window": (frame_time - last_frame_time) * 1000,
+                            "change": change,
+                        }
+                        self._logger.debug(
+                            "The first note falls between {}-{}: {}".format(
+                                self.from_row, self.to_row, result
+                            )
+                        )
+                        return result
+                elif not frozen:
+                    still_time += (frame_time - last_frame_time) * 1000
+                    if still_time >= self.freeze_time:
+                        frozen = True
+                        self._logger.debug(
+                            "Picture freezed, waiting for the first note..."
+                        )
+
+            last_color = color
+            last_frame_time = frame_time
+        return None
+
+    def stats(self) -> dict:
+        def mean_ms(values):
+            return statistics.mean(values) * 1000 if values else None
+
+        frame_interval = mean_ms(self._frame_times)
+        return {
+            "frames": self.frames,
+            "errors": self.errors,
+            "fps": 1000 / frame_interval if frame_interval else None,
+            "frame_interval": frame_interval,
+            "capture": mean_ms(self._capture_costs),
+            "reduce": mean_ms(self._reduce_costs),
+        }
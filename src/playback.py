@@ -0,0 +1,264 @@
+import logging
+import threading
+import time
+from collections import deque
+from typing import TYPE_CHECKING
+
+from minitouchpy import MNT, MNTEvATive7LogEventData, MNTEvent, MNTEventData
+
+from capture import CaptureService
+from chart import Chart
+from photogate import Photogate
+from resync import Resync
+from scheduler import CommandScheduler
+from util import get_runtime_info, mnt_write
+
+if TYPE_CHECKING:
+    import player
+
+# Playback of the current chart on mnt, kept apart from autodori so it can run
+# without MAA or the song list, e.g. on a vmnt.VirtualMNT
+
+OFFSET = {"up": 0, "down": 0, "move": 0, "wait": 0.0, "interval": 0.0}
+PHOTOGATE_LATENCY = 30
+# Capture frame interval in ms PHOTOGATE_LATENCY is for, the one measured while waiting
+# for the first note if None
+PHOTOGATE_FRAME_INTERVAL: float = None
+# Keep correcting the timing against notes crossing the photogate band during play
+RESYNC = False
+DEFAULT_MOVE_SLICE_SIZE = 10
+MOVE_TOLERANCE = 16
+FRAME_QUANTUM = 4
+# In ms of chart time: the length of a command chunk, how far ahead of the device
+# chunks are produced, and how little sent but not yet run time triggers the next one
+CMD_CHUNK_SIZE = 10
+CMD_LOOKAHEAD = 50
+CMD_WATERMARK = 20
+
+current_player: "player.Player" = None
+mnt: MNT = None
+current_chart: Chart = None
+# Photogate detection of the current play, saved with its play record
+last_photogate: dict = None
+callback_data: dict = {}
+callback_data_lock = threading.Lock()
+cmd_log_list: list[MNTEvATive7LogEventData] = []
+cmd_log_list_lock = threading.Lock()
+
+
+def reset_callback_data(last_cmd_endtime=-1):
+    global callback_data
+    callback_data = {
+        "wait": {"total": 0, "total_offset": 0.0},
+        "move": {"uncommited": 0, "total": 0, "total_offset": 0.0},
+        "up": {"uncommited": 0, "total": 0, "total_offset": 0.0},
+        "down": {"uncommited": 0, "total": 0, "total_offset": 0.0},
+        "interval": {"total": 0, "total_offset": 0.0},
+        # Commands run, and how much longer than asked they took in total
+        "commands": 0,
+        "cost": 0.0,
+        "last_cmd_endtime": last_cmd_endtime,
+    }
+
+
+reset_callback_data()
+
+
+def play_song(wait_first=True):
+    """
+    :param wait_first: wait for the first note on screen before playing, False to
+        start right away, e.g. on a vmnt.VirtualMNT
+    """
+    logging.info("Start play")
+    cmd_log_list.clear()
+    reset_callback_data()
+
+    # (commands, ms of cost budgeted for them) of every chunk produced, in the order
+    # they run, until the callbacks show they ran
+    chunk_budgets: deque[tuple[int, float]] = deque()
+
+    def _adjust_offset():
+        # Chunks are produced up to CMD_LOOKAHEAD ms before they run, with the OFFSET
+        # of that time, so the commands run since the last call are matched to the
+        # chunks they came from by counting, and only their own budget is taken off
+        executed = callback_data["commands"]
+        budget = 0.0
+        while executed and chunk_budgets:
+            commands, chunk_budget = chunk_budgets[0]
+            if commands > executed:
+                share = chunk_budget * executed / commands
+                chunk_budgets[0] = (commands - executed, chunk_budget - share)
+                budget += share
+                break
+            chunk_budgets.popleft()
+            executed -= commands
+            budget += chunk_budget
+        total_cost = callback_data["cost"] - budget
+
+        for type_ in ["up", "down", "move", "wait", "interval"]:
+            type_data = callback_data[type_]
+            total = type_data["total"]
+            if total != 0:
+                OFFSET[type_] = type_data["total_offset"] / total
+
+        current_chart._a2c_offset += total_cost
+        logging.debug("Adjust offset: {}".format(OFFSET))
+        logging.debug("Adjust _actions_to_cmd_offset: {}".format(total_cost))
+
+    def _produce():
+        size = current_chart.next_slice_size(CMD_CHUNK_SIZE)
+        if not size:
+            return None
+        with callback_data_lock:
+            _adjust_offset()
+            reset_callback_data(callback_data["last_cmd_endtime"])
+        if resync is not None:
+            current_chart._a2c_offset -= resync.take_correction()
+        budget = current_chart._a2c_budget
+        segments, wait = current_chart.stream_to_MNTcmd(OFFSET, size)
+        chunk_budgets.append(
+            (
+                sum(bytes(segment).count(b"\n") for segment in segments),
+                current_chart._a2c_budget - budget,
+            )
+        )
+        return segments, wait
+
+    def _publish(segments):
+        mnt_write(mnt, segments)
+        if current_chart.trace:
+            current_chart.trace.log_commands(scheduler.elapsed(), segments)
+
+    scheduler = CommandScheduler(
+        _produce,
+        _publish,
+        CMD_LOOKAHEAD,
+        CMD_WATERMARK,
+    )
+    resync: Resync = None
+    capture_service: CaptureService = None
+    scheduler.start_producer()
+    try:
+        if wait_first:
+            capture_service = create_band_capture().start()
+            wait_first_note(capture_service)
+            if RESYNC:
+                resync = Resync(
+                    capture_service,
+                    current_chart.get_note_times(),
+                    lambda: scheduler.start_time,
+                    float(current_chart.stream.times[0]),
+                    PHOTOGATE_LATENCY,
+                    frame_interval=PHOTOGATE_FRAME_INTERVAL,
+                ).start()
+            else:
+                capture_service.stop()
+        scheduler.run()
+    finally:
+        scheduler.stop()
+        if resync is not None:
+            resync.stop()
+            logging.debug("Resync stats: {}".format(resync.stats()))
+        if capture_service is not None:
+            capture_service.stop()
+    logging.debug("Scheduler stats: {}".format(scheduler.stats()))
+    time.sleep(2)
+    current_chart.close_trace()
+
+
+def create_band_capture() -> CaptureService:
+    """CaptureService of just the photogate band, not started yet."""
+    info = get_runtime_info(current_player.resolution)["wait_first"]
+    width = current_player.resolution[0]
+    band = [0, info["from"], width, info["to"] - info["from"] + 1]
+    return CaptureService(
+        lambda out: current_player.ipc_capture_display(band, out), (band[3], width, 3)
+    )
+
+
+def wait_first_note(capture_service: CaptureService):
+    seq = 0
+
+    def next_frame():
+        nonlocal seq
+        seq, timestamp, frame = capture_service.wait_next(seq)
+        return timestamp, frame
+
+    global last_photogate
+    photogate = Photogate(next_frame, 0, capture_service.shape[0] - 1)
+    detection = photogate.wait()
+    photogate_stats = photogate.stats()
+    logging.debug(
+        "Photogate stats: {}, capture stats: {}".format(
+            photogate_stats, capture_service.stats()
+        )
+    )
+    # The note reaches the judgement line PHOTOGATE_LATENCY after the gate detects it.
+    # That includes the half frame interval it crosses the band before the frame it
+    # is seen in on average, so only correct for this interval being longer or shorter.
+    frame_interval = photogate_stats["frame_interval"]
+    reference_interval = PHOTOGATE_FRAME_INTERVAL or frame_interval
+    correction = (detection["window"] - reference_interval) / 2
+    elapsed = (time.perf_counter() - detection["detect_time"]) * 1000
+    time.sleep(max(0, PHOTOGATE_LATENCY - correction - elapsed) / 1000)
+    last_photogate = {
+        "latency": PHOTOGATE_LATENCY,
+        "reference_interval": reference_interval,
+        "frame_interval": frame_interval,
+        "window": detection["window"],
+        "correction": correction,
+        "elapsed": elapsed,
+    }
+
+
+def mnt_callback(event: MNTEvent, data: MNTEventData):
+    global callback_data
+    if event == MNTEvent.EVATIVE7_LOG:
+        data: MNTEvATive7LogEventData = data
+
+        cmd = data.cmd
+        cost = data.cost
+
+        with cmd_log_list_lock:
+            cmd_log_list.append(data)
+        if current_chart is not None and current_chart.trace:
+            current_chart.trace.log_mnt(data)
+        cmd_type = cmd.split(" ")[0]
+
+        callback_data_lock.acquire()
+
+        callback_data["commands"] += 1
+        if (last_cmd_endtime := callback_data.get("last_cmd_endtime")) != -1:
+            callback_data["interval"]["total"] += 1
+            callback_data["interval"]["total_offset"] += (
+                data.start_time - last_cmd_endtime
+            )
+            callback_data["cost"] += data.start_time - last_cmd_endtime
+        callback_data["last_cmd_endtime"] = data.end_time
+        if cmd_type in ["w"]:
+            callback_data["wait"]["total"] += 1
+            callback_data["wait"]["total_offset"] += cost - int(cmd.split(" ")[-1])
+            callback_data["cost"] += cost - int(cmd.split(" ")[-1])
+        else:
+            callback_data["cost"] += cost
+        if cmd_type in ["u", "d", "m"]:
+            type_ = {
+                "u": "up",
+                "d": "down",
+                "m": "move",
+            }[cmd_type]
+            callback_data[type_]["uncommited"] += 1
+            callback_data[type_]["total"] += 1
+            callback_data[type_]["total_offset"] += cost
+        elif cmd_type in ["c"]:
+            total_uncommited = 0
+            for type_ in ["up", "down", "move"]:
+                total_uncommited += callback_data[type_]["uncommited"]
+
+            if total_uncommited != 0:
+                for type_ in ["up", "down", "move"]:
+                    callback_data[type_]["total_offset"] += cost * (
+                        callback_data[type_]["uncommited"] / total_uncommited
+                    )
+                    callback_data[type_]["uncommited"] = 0
+        callback_data_lock.release()
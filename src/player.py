@@ -1,5 +1,8 @@
+import ctypes
+
 import mumuipc
 import ldipc
+import numpy as np
 
 
 class Player:
@@ -12,19 +15,81 @@ class Player:
             self.player = mumuipc.MuMuPlayer(path, index, "v5")
         elif type_ == "ld":
             self.player = ldipc.LDPlayer(path, index)
+        self._buffer = None
+        self._frame: np.ndarray = None
 
     @property
     def resolution(self):
         return self.player.resolution
 
-    def ipc_capture_display(self):
+    def _capture_mumu(self) -> np.ndarray:
+        # Capture into one buffer kept across calls instead of a new one every frame
+        if self.display_id == -1:
+            self.display_id = self.player.ipc_get_display_id("com.bilibili.star.bili")
+        width, height = self.resolution
+        if self._buffer is None:
+            self._buffer = (ctypes.c_ubyte * (width * height * 4))()
+            # The display is captured bottom-up
+            self._frame = np.frombuffer(self._buffer, dtype=np.uint8).reshape(
+                (height, width, 4)
+            )[::-1]
+        if self.player.dll.nemu_capture_display(
+            self.player._handle,
+            self.display_id,
+            len(self._buffer),
+            ctypes.byref(ctypes.c_int(0)),
+            ctypes.byref(ctypes.c_int(0)),
+            self._buffer,
+        ):
+            raise RuntimeError("nemu_capture_display failed")
+        # RGBA
+        return self._frame
+
+    def _capture_ld(self) -> np.ndarray:
+        # A view of the frame in the DLL's memory, which is only valid until the next
+        # capture, so it is always cropped into a copy
+        width, height = self.resolution
+        screenshot = self.player._screenshot_instance
+        img_ptr = screenshot.vtable.contents.cap(self.player.screenshot_instance_ptr)
+        if not img_ptr:
+            raise RuntimeError("cap() returned NULL")
+        pixels = (ctypes.c_ubyte * (width * height * 3)).from_address(img_ptr)
+        # Bottom-up BGR -> RGB
+        return np.frombuffer(pixels, dtype=np.uint8).reshape((height, width, 3))[
+            ::-1, :, ::-1
+        ]
+
+    def ipc_capture_display(
+        self, roi=None, out: np.ndarray = None, rgba: bool = False
+    ) -> np.ndarray:
+        """
+        Capture the display, or a region of it.
+
+        Neither IPC captures a region natively, so the region is a view of the full
+        frame. On mumu that frame lives in a buffer reused by every capture, and the
+        RGB or RGBA result is a view of it, valid until the next capture. On ld it is
+        copied, and only the region is.
+
+        :param roi: [x, y, w, h] to capture, the whole display if None
+        :param out: preallocated (h, w, 3) or (h, w, 4) array to copy the capture into
+            and return, e.g. to keep it past the next capture
+        :param rgba: capture 4 channels, only on mumu
+        """
         if self.type.startswith("mumu"):
-            if self.display_id == -1:
-                self.display_id = self.player.ipc_get_display_id(
-                    "com.bilibili.star.bili"
-                )
-            # RGBA -> RGB
-            return self.player.ipc_capture_display(self.display_id)[:, :, :3]
+            frame = self._capture_mumu()
+            if not rgba:
+                frame = frame[:, :, :3]
         else:
-            # RGB
-            return self.player.capture()
+            if rgba:
+                raise ValueError("ld captures have no alpha channel")
+            frame = self._capture_ld()
+
+        if roi is not None:
+            x, y, w, h = roi
+            frame = frame[y : y + h, x : x + w]
+        if out is not None:
+            np.copyto(out, frame)
+            return out
+        if not self.type.startswith("mumu"):
+            return frame.copy()
+        return frame
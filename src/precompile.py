@@ -0,0 +1,115 @@
+import json
+import logging
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from pathlib import Path
+
+from api import BestdoriAPI
+from chart import Chart
+from chartcache import CompiledChartCache
+
+# Index of each difficulty in the song list's "difficulty" field
+DIFFICULTIES = ["easy", "normal", "hard", "expert", "special"]
+
+
+def get_jobs(song_list: dict, difficulties: list[str]) -> list[tuple[str, str]]:
+    """(song_id, difficulty) of every chart in the song list with those difficulties."""
+    jobs = []
+    for song_id, song in song_list.items():
+        available = song.get("difficulty", {})
+        for difficulty in difficulties:
+            if str(DIFFICULTIES.index(difficulty)) in available:
+                jobs.append((song_id, difficulty))
+    return jobs
+
+
+def compile_chart(
+    song_id, difficulty, move_slice_size, move_tolerance, frame_quantum
+) -> dict:
+    """Fetch and compile one chart into CompiledChartCache. Runs in a worker process."""
+    start = time.perf_counter()
+    hits = CompiledChartCache.hits
+    chart = Chart((song_id, difficulty))
+    chart.load_actions(move_slice_size, move_tolerance, frame_quantum)
+    return {
+        "time": time.perf_counter() - start,
+        "cached": CompiledChartCache.hits > hits,
+        "actions": len(chart.actions),
+    }
+
+
+def precompile(
+    difficulties: list[str],
+    move_slice_size,
+    move_tolerance=None,
+    frame_quantum=0.001,
+    workers: int = None,
+    pack: Path = None,
+    offline: bool = False,
+) -> dict:
+    """
+    Compile every chart of the song list with the given difficulties across a
+    process pool, so playing never waits on notes_to_actions.
+
+    :param workers: number of processes, one per CPU if None
+    :param pack: chart pack for the workers to read charts from, see
+        BestdoriAPI.use_pack
+    :return: report with the timing of every chart and the failures
+    """
+    logger = logging.getLogger("precompile")
+    jobs = get_jobs(BestdoriAPI.get_song_list(), difficulties)
+    logger.info(f"Precompiling {len(jobs)} charts of {', '.join(difficulties)}")
+
+    charts = {}
+    failures = {}
+    start = time.perf_counter()
+    with ProcessPoolExecutor(
+        workers,
+        initializer=BestdoriAPI.use_pack if pack else None,
+        initargs=(pack, offline) if pack else (),
+    ) as executor:
+        futures = {
+            executor.submit(
+                compile_chart,
+                song_id,
+                difficulty,
+                move_slice_size,
+                move_tolerance,
+                frame_quantum,
+            ): f"{song_id}-{difficulty}"
+            for song_id, difficulty in jobs
+        }
+        for done, future in enumerate(as_completed(futures), 1):
+            name = futures[future]
+            try:
+                charts[name] = future.result()
+            except Exception as e:
+                failures[name] = repr(e)
+                logger.error(f"Failed to precompile {name}: {e}")
+            if done % 50 == 0 or done == len(jobs):
+                logger.info(f"Precompiled {done}/{len(jobs)}")
+
+    compiled = {name: info for name, info in charts.items() if not info["cached"]}
+    report = {
+        "total": len(jobs),
+        "compiled": len(compiled),
+        "cached": len(charts) - len(compiled),
+        "failed": len(failures),
+        "elapsed": time.perf_counter() - start,
+        "compile_time": sum(info["time"] for info in compiled.values()),
+        "charts": charts,
+        "failures": failures,
+    }
+
+    report_path = Path("debug") / f"precompile-{int(time.time())}.json"
+    report_path.write_text(json.dumps(report, indent=2), "utf-8")
+    logger.info(
+        "Precompiled {total} charts in {elapsed:.1f}s: {compiled} compiled ({compile_time:.1f}s"
+        " of work), {cached} already cached, {failed} failed".format(**report)
+    )
+    for name, info in sorted(compiled.items(), key=lambda item: -item[1]["time"])[:10]:
+        logger.info(f"Slowest: {name} {info['time'] * 1000:.0f}ms")
+    for name, error in failures.items():
+        logger.warning(f"Failed: {name} {error}")
+    logger.info(f"Report written to {report_path}")
+    return report
@@ -0,0 +1,178 @@
+import logging
+import statistics
+import threading
+from collections import deque
+from typing import Callable, Optional
+
+import numpy as np
+
+from capture import CaptureService
+from photogate import band_color
+
+
+class Resync:
+    """
+    Keep estimating during play how far the screen is from the chart clock, from
+    notes crossing the photogate band.
+
+    Every frame of `capture_service` is reduced to the band's mean color, and the
+    band getting brighter by more than `threshold` is taken as a note crossing it.
+    Like the photogate, a crossing is timed by the frame it is seen in, corrected by
+    half of how much longer or shorter than average the interval before it was.
+    It is matched to the note due at the judgement line `band_latency` ms later, if
+    that note is the only one within `isolation` ms and is due within `match_window`
+    ms of it. The median offset of the last `samples` matches is the estimate, and
+    whenever it moves by `deadband` ms or more, the change is left for the command
+    producer to pick up with take_correction.
+
+    The offset is measured against the clock the chart is played on, not the
+    corrected one, so corrections never feed back into it.
+    """
+
+    def __init__(
+        self,
+        capture_service: CaptureService,
+        note_times: np.ndarray,
+        clock_start: Callable[[], Optional[float]],
+        first_time: float,
+        band_latency: float,
+        threshold: float = 3,
+        match_window: float = 60,
+        isolation: float = 150,
+        samples: int = 8,
+        min_samples: int = 3,
+        deadband: float = 2,
+        max_correction: float = 100,
+        frame_interval: float = None,
+    ):
+        """
+        :param capture_service: captures just the photogate band
+        :param note_times: sorted judgement times of the notes in ms, see
+            Chart.get_note_times
+        :param clock_start: returns the time.perf_counter time `first_time` was
+            played at, None before playing starts, e.g. CommandScheduler.start_time
+        :param first_time: chart time in ms of the first command
+        :param band_latency: ms from a note being seen crossing the band to reaching
+            the judgement line, i.e. PHOTOGATE_LATENCY
+        :param frame_interval: frame interval in ms band_latency is for, i.e.
+            PHOTOGATE_FRAME_INTERVAL, the capture's mean one if None
+        """
+        self.capture_service = capture_service
+        self.note_times = note_times
+        self.clock_start = clock_start
+        self.first_time = first_time
+        self.band_latency = band_latency
+        self.threshold = threshold
+        self.match_window = match_window
+        self.samples = samples
+        self.min_samples = min_samples
+        self.deadband = deadband
+        self.max_correction = max_correction
+        self.frame_interval = frame_interval
+        self._logger = logging.getLogger("resync")
+
+        gaps = np.diff(note_times)
+        self._isolated = np.concatenate([[True], gaps >= isolation]) & np.concatenate(
+            [gaps >= isolation, [True]]
+        )
+        self._offsets = deque(maxlen=samples)
+        self._lock = threading.Lock()
+        self._pending = 0.0
+        self._running = False
+        self._thread: threading.Thread = None
+
+        self.events = 0
+        self.matched = 0
+        self.corrections = 0
+        self.applied = 0.0
+
+    def start(self):
+        self._running = True
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._running = False
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def _run(self):
+        seq = 0
+        last_color = None
+        last_time = None
+        rising = False
+        while self._running:
+            if (item := self.capture_service.wait_next(seq, timeout=0.1)) is None:
+                continue
+            seq, frame_time, frame = item
+            color = band_color(frame, 0, frame.shape[0] - 1)
+            if last_color is not None:
+                change = float(np.sum(color - last_color))
+                if change > self.threshold and not rising:
+                    if self.frame_interval is not None:
+                        reference = self.frame_interval / 1000
+                    elif fps := self.capture_service.stats()["fps"]:
+                        reference = 1 / fps
+                    else:
+                        reference = frame_time - last_time
+                    self._on_crossing(
+                        frame_time - (frame_time - last_time - reference) / 2
+                    )
+                rising = change > self.threshold
+            last_color = color
+            last_time = frame_time
+
+    def _on_crossing(self, crossing_time: float):
+        start = self.clock_start()
+        if start is None or not len(self.note_times):
+            return
+        self.events += 1
+        # Chart time the crossing note reaches the judgement line at on the screen
+        arrival = (crossing_time - start) * 1000 + self.first_time + self.band_latency
+        index = int(np.searchsorted(self.note_times, arrival))
+        nearest = min(
+            range(max(0, index - 1), min(len(self.note_times), index + 1)),
+            key=lambda i: abs(self.note_times[i] - arrival),
+        )
+        offset = arrival - float(self.note_times[nearest])
+        if not self._isolated[nearest] or abs(offset) > self.match_window:
+            return
+
+        self.matched += 1
+        self._offsets.append(offset)
+        if len(self._offsets) < self.min_samples:
+            return
+        target = min(
+            self.max_correction,
+            max(-self.max_correction, statistics.median(self._offsets)),
+        )
+        if abs(target - self.applied) < self.deadband:
+            return
+        with self._lock:
+            self._pending += target - self.applied
+        self._logger.debug(
+            f"Screen is {target:.1f}ms behind the chart clock, correcting by "
+            f"{target - self.applied:+.1f}ms"
+        )
+        self.applied = target
+        self.corrections += 1
+
+    def take_correction(self) -> float:
+        """
+        ms to delay the commands not produced yet by, negative to advance them, since
+        the last call.
+        """
+        with self._lock:
+            pending, self._pending = self._pending, 0.0
+        return pending
+
+    def stats(self) -> dict:
+        return {
+            "events": self.events,
+            "matched": self.matched,
+            "corrections": self.corrections,
+            "offset": statistics.median(self._offsets) if self._offsets else None,
+            "applied": self.applied,
+        }
@@ -0,0 +1,130 @@
+import logging
+import queue
+import threading
+import time
+from typing import Any, Callable, Optional
+
+
+class CommandScheduler:
+    """
+    Feed command chunks to the device ahead of its clock.
+
+    A producer thread keeps up to `lookahead` ms of chunks queued, and `run` publishes
+    a chunk whenever the commands already sent cover less than `watermark` ms of
+    device time. The device clock starts when `run` is called.
+    """
+
+    def __init__(
+        self,
+        produce: Callable[[], Optional[tuple[Any, float]]],
+        publish: Callable[[Any], None],
+        lookahead: float = 50,
+        watermark: float = 20,
+    ):
+        """
+        :param produce: returns (chunk, wait length in ms), or None when there is nothing left
+        :param publish: sends a chunk to the device
+        """
+        self._produce = produce
+        self._publish = publish
+        self.lookahead = lookahead
+        self.watermark = watermark
+        self._logger = logging.getLogger("CommandScheduler")
+        self._queue = queue.Queue()
+        self._stopped = threading.Event()
+        self._started = threading.Event()
+        self._producer: threading.Thread = None
+        self._start_time: float = None
+        self._produced_until = 0.0
+        self._published_until = 0.0
+
+        self.produced = 0
+        self.published = 0
+        self.starved = 0
+        self.min_ahead = None
+
+    @property
+    def start_time(self) -> Optional[float]:
+        """time.perf_counter() when `run` was called, None before."""
+        return self._start_time
+
+    def elapsed(self) -> float:
+        if self._start_time is None:
+            return 0.0
+        return (time.perf_counter() - self._start_time) * 1000
+
+    def ahead(self) -> float:
+        """Device time, in ms, covered by published commands that has not elapsed yet."""
+        return self._published_until - self.elapsed()
+
+    def start_producer(self):
+        self._producer = threading.Thread(target=self._produce_loop, daemon=True)
+        self._producer.start()
+
+    def _produce_loop(self):
+        # Fill the queue up to lookahead, then wait for the clock to start
+        while not self._stopped.is_set():
+            if self._start_time is None and self._produced_until > self.lookahead:
+                self._started.wait()
+                continue
+            produced_ahead = self._produced_until - self.elapsed()
+            if produced_ahead > self.lookahead:
+                self._stopped.wait((produced_ahead - self.lookahead) / 1000)
+                continue
+
+            try:
+                produced = self._produce()
+            except Exception as e:
+                self._logger.error(f"Failed to produce commands: {e}", stack_info=True)
+                produced = None
+
+            if produced is None:
+                self._queue.put(None)
+                return
+            chunk, wait = produced
+            self._produced_until += wait
+            self.produced += 1
+            self._queue.put((chunk, wait))
+
+    def run(self):
+        """Publish chunks until the producer runs out."""
+        if self._producer is None:
+            self.start_producer()
+        self._start_time = time.perf_counter()
+        self._started.set()
+
+        while not self._stopped.is_set():
+            ahead = self.ahead()
+            if ahead >= self.watermark:
+                time.sleep((ahead - self.watermark) / 1000)
+                continue
+
+            try:
+                item = self._queue.get_nowait()
+            except queue.Empty:
+                self.starved += 1
+                item = self._queue.get()
+            if item is None:
+                break
+
+            chunk, wait = item
+            self.min_ahead = (
+                ahead if self.min_ahead is None else min(self.min_ahead, ahead)
+            )
+            self._publish(chunk)
+            self.published += 1
+            self._published_until = max(self._published_until, self.elapsed()) + wait
+
+        self.stop()
+
+    def stop(self):
+        self._stopped.set()
+        self._started.set()
+
+    def stats(self) -> dict:
+        return {
+            "produced": self.produced,
+            "published": self.published,
+            "starved": self.starved,
+            "min_ahead": self.min_ahead,
+        }
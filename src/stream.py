@@ -0,0 +1,126 @@
+import io
+from pathlib import Path
+
+import numpy as np
+
+from timeline import DOWN, MOVE, UP, WAIT, ActionTimeline
+
+
+class CommandStream:
+    """
+    A whole action timeline compiled to minitouch bytes.
+
+    `data` holds every touch frame back to back, each one ending with "c\\n".
+    Frame i spans data[ends[i - 1]:ends[i]], starts at chart time times[i] and is
+    followed on the device by a wait of waits[i] ms (0 for the last frame). The
+    waits are kept out of `data` so playback can still correct them on the fly.
+    """
+
+    def __init__(
+        self,
+        data: bytes,
+        ends: np.ndarray,
+        times: np.ndarray,
+        waits: np.ndarray,
+        counts: np.ndarray,
+    ):
+        """
+        :param counts: (N, 3) number of down, move and up commands in each frame
+        """
+        self.data = data
+        self.view = memoryview(data)
+        self.ends = ends
+        self.times = times
+        self.waits = waits
+        self.counts = counts
+
+    def __len__(self):
+        return len(self.ends)
+
+    def start_of(self, frame: int) -> int:
+        return int(self.ends[frame - 1]) if frame > 0 else 0
+
+    def frames(self, start: int, stop: int) -> memoryview:
+        """Bytes of frames [start, stop), without the waits between them."""
+        return self.view[self.start_of(start) : self.start_of(stop)]
+
+    def search(self, time_: float) -> int:
+        """Index of the first frame starting at or after time_."""
+        return int(np.searchsorted(self.times, time_, side="left"))
+
+    @staticmethod
+    def compile(actions: ActionTimeline, positions: np.ndarray) -> "CommandStream":
+        """
+        :param positions: (N, 2) minitouch coordinates of every action
+        """
+        data = bytearray()
+        ends, times, waits, counts = [], [], [], []
+        frame_time = None
+        frame_counts = [0, 0, 0]
+
+        def close_frame(wait):
+            nonlocal frame_time, frame_counts
+            data.extend(b"c\n")
+            ends.append(len(data))
+            times.append(frame_time)
+            waits.append(wait)
+            counts.append(frame_counts)
+            frame_time = None
+            frame_counts = [0, 0, 0]
+
+        for (time_, type_, finger, _, _, _, length), (x, y) in zip(
+            actions.array.tolist(), positions.tolist()
+        ):
+            if frame_time is None:
+                frame_time = time_
+            if type_ == DOWN:
+                data.extend(b"d %d %d %d 1\n" % (finger, x, y))
+                frame_counts[0] += 1
+            elif type_ == MOVE:
+                data.extend(b"m %d %d %d 1\n" % (finger, x, y))
+                frame_counts[1] += 1
+            elif type_ == UP:
+                data.extend(b"u %d\n" % finger)
+                frame_counts[2] += 1
+            elif type_ == WAIT:
+                close_frame(length)
+        if frame_time is not None:
+            close_frame(0.0)
+
+        return CommandStream(
+            bytes(data),
+            np.array(ends, dtype=np.int64),
+            np.array(times, dtype=np.float64),
+            np.array(waits, dtype=np.float64),
+            np.array(counts, dtype=np.int32).reshape(-1, 3),
+        )
+
+    def to_bytes(self) -> bytes:
+        buffer = io.BytesIO()
+        np.savez_compressed(
+            buffer,
+            data=np.frombuffer(self.data, dtype=np.uint8),
+            ends=self.ends,
+            times=self.times,
+            waits=self.waits,
+            counts=self.counts,
+        )
+        return buffer.getvalue()
+
+    @staticmethod
+    def from_bytes(data: bytes) -> "CommandStream":
+        with np.load(io.BytesIO(data), allow_pickle=False) as arrays:
+            return CommandStream(
+                arrays["data"].tobytes(),
+                arrays["ends"],
+                arrays["times"],
+                arrays["waits"],
+                arrays["counts"],
+            )
+
+    def save(self, path: Path):
+        Path(path).write_bytes(self.to_bytes())
+
+    @staticmethod
+    def load(path: Path) -> "CommandStream":
+        return CommandStream.from_bytes(Path(path).read_bytes())
@@ -0,0 +1,71 @@
+from bisect import bisect_right
+
+import numpy as np
+
+
+class TempoMap:
+    """
+    Beat <-> millisecond conversion for a chart's BPM changes.
+
+    Segment start times are accumulated once, so each lookup is a binary search.
+    Beats before the first BPM change map to 0, as there is no tempo yet.
+    """
+
+    def __init__(self, bpms: list[tuple[float, float]]):
+        """
+        :param bpms: list of (bpm, beat), in any order
+        """
+        bpms = sorted(bpms, key=lambda bpm_and_beat: bpm_and_beat[1])
+
+        self._beats = np.array([beat for _, beat in bpms], dtype=np.float64)
+        # ms per beat, 0 for a zero (or missing) bpm
+        self._ms_per_beat = np.array(
+            [60000.0 / bpm if bpm else 0.0 for bpm, _ in bpms], dtype=np.float64
+        )
+        self._times = np.zeros(len(bpms), dtype=np.float64)
+        if len(bpms) > 1:
+            self._times[1:] = np.cumsum(np.diff(self._beats) * self._ms_per_beat[:-1])
+        self._beats_list = self._beats.tolist()
+        self._times_list = self._times.tolist()
+        self._ms_per_beat_list = self._ms_per_beat.tolist()
+
+    def __len__(self):
+        return len(self._beats_list)
+
+    def beat_to_time(self, beat: float) -> float:
+        i = bisect_right(self._beats_list, beat) - 1
+        if i < 0:
+            return 0.0
+        return self._times_list[i] + (beat - self._beats_list[i]) * (
+            self._ms_per_beat_list[i]
+        )
+
+    def time_to_beat(self, time_: float) -> float:
+        if not self._beats_list:
+            return 0.0
+        i = max(0, bisect_right(self._times_list, time_) - 1)
+        ms_per_beat = self._ms_per_beat_list[i]
+        if not ms_per_beat:
+            return self._beats_list[i]
+        return self._beats_list[i] + (time_ - self._times_list[i]) / ms_per_beat
+
+    def beats_to_times(self, beats) -> np.ndarray:
+        beats = np.asarray(beats, dtype=np.float64)
+        if not self._beats_list:
+            return np.zeros_like(beats)
+        i = np.searchsorted(self._beats, beats, side="right") - 1
+        clipped = np.maximum(i, 0)
+        times = self._times[clipped] + (beats - self._beats[clipped]) * (
+            self._ms_per_beat[clipped]
+        )
+        return np.where(i < 0, 0.0, times)
+
+    def times_to_beats(self, times) -> np.ndarray:
+        times = np.asarray(times, dtype=np.float64)
+        if not self._beats_list:
+            return np.zeros_like(times)
+        i = np.maximum(np.searchsorted(self._times, times, side="right") - 1, 0)
+        ms_per_beat = self._ms_per_beat[i]
+        with np.errstate(divide="ignore", invalid="ignore"):
+            beats = self._beats[i] + (times - self._times[i]) / ms_per_beat
+        return np.where(ms_per_beat == 0, self._beats[i], beats)
@@ -1,18 +1,29 @@
 import autodori
+import playback
+from util import configure_log
 
 FUZZYSONGNAME = "寄る辺のSunny,Sunny"
 
 autodori.DIFFICULTY = "expert"
-autodori.OFFSET = {"up": 0, "down": 0, "move": 0, "wait": 0.0, "interval": 0.0}
-autodori.PHOTOGATE_LATENCY = 30
-autodori.DEFAULT_MOVE_SLICE_SIZE = 20
-autodori.CMD_SLICE_SIZE = 100
+playback.OFFSET = {"up": 0, "down": 0, "move": 0, "wait": 0.0, "interval": 0.0}
+playback.PHOTOGATE_LATENCY = 30
+autodori.CALIBRATE_PHOTOGATE = False
+playback.RESYNC = False
+playback.DEFAULT_MOVE_SLICE_SIZE = 20
+playback.MOVE_TOLERANCE = 16
+playback.FRAME_QUANTUM = 4
+autodori.SONG_OCR_STRATEGY = "early-exit"
+playback.CMD_CHUNK_SIZE = 10
+playback.CMD_LOOKAHEAD = 50
+playback.CMD_WATERMARK = 20
 
-autodori.configure_log()
+configure_log()
+autodori.load_config()
+autodori.init()
 autodori.init_maa()
 autodori.init_player_and_mnt()
 autodori.save_song(autodori.fuzzy_match_song(FUZZYSONGNAME)[0])
-autodori.current_chart.dump_debug_config()
-autodori.play_song()  # Please interrupt the function. After entering the live interface, resume execution
-autodori.mnt.stop()
+playback.current_chart.dump_debug_config()
+playback.play_song()  # Please interrupt the function. After entering the live interface, resume execution
+playback.mnt.stop()
 exit()
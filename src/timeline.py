@@ -0,0 +1,168 @@
+import io
+import zlib
+
+import numpy as np
+
+DOWN, MOVE, UP, WAIT = range(4)
+ACTION_TYPES = ["down", "move", "up", "wait"]
+ACTION_DTYPE = np.dtype(
+    [
+        ("time", np.float64),
+        ("type", np.uint8),
+        ("finger", np.uint8),
+        ("x", np.float64),
+        ("y", np.float64),
+        ("note", np.int32),
+        ("length", np.float64),
+    ]
+)
+
+
+class ActionTimeline:
+    """
+    Down/move/up/wait actions as a structured array.
+
+    Slicing returns a view and indexing returns the same dict an action used to be,
+    so code written against the old list of dicts keeps working.
+    """
+
+    def __init__(self, array: np.ndarray = None, start: int = 0):
+        if array is None:
+            array = np.zeros(0, dtype=ACTION_DTYPE)
+        self.array = array
+        self._start = start
+
+    def __len__(self):
+        return len(self.array)
+
+    def __bool__(self):
+        return len(self.array) > 0
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            start, _, step = key.indices(len(self.array))
+            if step != 1:
+                raise ValueError("ActionTimeline slices do not support a step")
+            return ActionTimeline(self.array[key], self._start + start)
+        if key < 0:
+            key += len(self.array)
+        return self._to_dict(self._start + key, self.array[key].tolist())
+
+    def __iter__(self):
+        for i, row in enumerate(self.array.tolist()):
+            yield self._to_dict(self._start + i, row)
+
+    @staticmethod
+    def _to_dict(index, row) -> dict:
+        time_, type_, finger, x, y, note, length = row
+        if type_ == WAIT:
+            return {"type": "wait", "time": time_, "length": length, "index": index}
+        action = {"finger": finger, "type": ACTION_TYPES[type_], "time": time_}
+        if type_ == DOWN:
+            action["pos"] = (x, y)
+        elif type_ == MOVE:
+            action["to"] = (x, y)
+        action["note"] = note if note != -1 else None
+        action["index"] = index
+        return action
+
+    @property
+    def start(self) -> int:
+        return self._start
+
+    def rows(self):
+        """Yield (index, type, finger, x, y, length) without building dicts."""
+        for i, (_, type_, finger, x, y, _, length) in enumerate(self.array.tolist()):
+            yield self._start + i, type_, finger, x, y, length
+
+    def points(self) -> np.ndarray:
+        """(N, 2) array of normalized x, y."""
+        return np.column_stack((self.array["x"], self.array["y"]))
+
+    def search(self, time_: float) -> int:
+        """Position of the first action at or after time_."""
+        return int(np.searchsorted(self.array["time"], time_, side="left"))
+
+    def wait_total(self) -> float:
+        return float(self.array["length"][self.array["type"] == WAIT].sum())
+
+    def to_dicts(self) -> list[dict]:
+        return list(self)
+
+    def to_bytes(self) -> bytes:
+        buffer = io.BytesIO()
+        np.save(buffer, np.ascontiguousarray(self.array), allow_pickle=False)
+        return zlib.compress(buffer.getvalue())
+
+    @staticmethod
+    def from_bytes(data: bytes) -> "ActionTimeline":
+        return ActionTimeline(
+            np.load(io.BytesIO(zlib.decompress(data)), allow_pickle=False)
+        )
+
+
+class ActionTimelineBuilder:
+    def __init__(self):
+        self._rows = []
+
+    def down(self, finger, time_, pos, note=None):
+        self._rows.append((time_, DOWN, finger, *pos, -1 if note is None else note, 0))
+
+    def move(self, finger, time_, to, note=None):
+        self._rows.append((time_, MOVE, finger, *to, -1 if note is None else note, 0))
+
+    def up(self, finger, time_, note=None):
+        self._rows.append((time_, UP, finger, 0, 0, -1 if note is None else note, 0))
+
+    def build(self, quantum=0.001) -> ActionTimeline:
+        """
+        Sort actions by time (stable), batch them into frames and put a wait between frames.
+
+        A frame takes every action within `quantum` ms of its first one, and all of them
+        are moved to that time, so they reach the device in one commit. A finger
+        that is released and pressed again starts a new frame, since minitouch
+        needs a commit in between.
+        """
+        actions = np.array(self._rows, dtype=ACTION_DTYPE)
+        actions = actions[np.argsort(actions["time"], kind="stable")]
+
+        frame_starts = np.zeros(len(actions), dtype=bool)
+        frame_time = None
+        released = set()
+        for i, (time_, type_, finger) in enumerate(
+            zip(
+                actions["time"].tolist(),
+                actions["type"].tolist(),
+                actions["finger"].tolist(),
+            )
+        ):
+            if (
+                frame_time is None
+                or time_ - frame_time > quantum
+                or (type_ == DOWN and finger in released)
+            ):
+                frame_starts[i] = True
+                frame_time = time_
+                released = set()
+            if type_ == UP:
+                released.add(finger)
+
+        frame_ids = np.cumsum(frame_starts) - 1
+        frame_times = actions["time"][frame_starts]
+        actions["time"] = frame_times[frame_ids]
+
+        has_wait = frame_starts[1:]
+        waits_before = np.zeros(len(actions), dtype=np.int64)
+        np.cumsum(has_wait, out=waits_before[1:])
+        positions = np.arange(len(actions)) + waits_before
+
+        result = np.zeros(len(actions) + int(has_wait.sum()), dtype=ACTION_DTYPE)
+        result[positions] = actions
+
+        wait_positions = positions[:-1][has_wait] + 1
+        result["type"][wait_positions] = WAIT
+        result["note"][wait_positions] = -1
+        result["time"][wait_positions] = actions["time"][:-1][has_wait]
+        result["length"][wait_positions] = np.diff(frame_times)
+
+        return ActionTimeline(result)
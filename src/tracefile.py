@@ -0,0 +1,207 @@
+import argparse
+import io
+import json
+import struct
+import sys
+import threading
+import zlib
+from pathlib import Path
+
+import numpy as np
+import yaml
+
+from stream import CommandStream
+from timeline import ActionTimeline
+
+MAGIC = b"ADTRACE1"
+# kind length, payload length
+RECORD_HEADER = struct.Struct("<BI")
+MNT_LOG_COLUMNS = ["start_time", "end_time", "cost"]
+
+
+class TraceWriter:
+    """
+    Append-only binary trace of a play.
+
+    The file is MAGIC followed by records of (kind, payload). Chart, actions and the
+    command stream are written once up front, MNT log events are buffered and
+    written as compressed columns every `chunk_size` events, and published commands
+    are written as they go out, so a trace costs little more than a file write.
+    """
+
+    def __init__(self, path: Path, chunk_size: int = 1024):
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.chunk_size = chunk_size
+        self._file = open(self.path, "wb")
+        self._file.write(MAGIC)
+        self._lock = threading.Lock()
+        self._mnt_log = {column: [] for column in MNT_LOG_COLUMNS + ["cmd"]}
+
+    def write_record(self, kind: str, payload: bytes):
+        kind = kind.encode()
+        with self._lock:
+            if self._file.closed:
+                return
+            self._file.write(RECORD_HEADER.pack(len(kind), len(payload)))
+            self._file.write(kind)
+            self._file.write(payload)
+
+    def write_json(self, kind: str, value):
+        self.write_record(
+            kind, zlib.compress(json.dumps(value, ensure_ascii=False).encode())
+        )
+
+    def write_actions(self, actions: ActionTimeline):
+        self.write_record("actions", actions.to_bytes())
+
+    def write_stream(self, stream: CommandStream):
+        self.write_record("stream", stream.to_bytes())
+
+    def log_commands(self, elapsed: float, segments: list):
+        """Commands published to minitouch `elapsed` ms into the play."""
+        data = b"".join(bytes(segment) for segment in segments)
+        self.write_record("commands", struct.pack("<d", elapsed) + data)
+
+    def log_mnt(self, data):
+        """
+        :param data: MNTEvATive7LogEventData
+        """
+        with self._lock:
+            for column in MNT_LOG_COLUMNS:
+                self._mnt_log[column].append(getattr(data, column))
+            self._mnt_log["cmd"].append(data.cmd)
+            full = len(self._mnt_log["cmd"]) >= self.chunk_size
+        if full:
+            self.flush_mnt_log()
+
+    def flush_mnt_log(self):
+        with self._lock:
+            mnt_log = self._mnt_log
+            self._mnt_log = {column: [] for column in MNT_LOG_COLUMNS + ["cmd"]}
+        if not mnt_log["cmd"]:
+            return
+
+        buffer = io.BytesIO()
+        np.savez_compressed(
+            buffer,
+            cmd=np.frombuffer("\n".join(mnt_log["cmd"]).encode(), dtype=np.uint8),
+            **{
+                column: np.array(mnt_log[column], dtype=np.float64)
+                for column in MNT_LOG_COLUMNS
+            },
+        )
+        self.write_record("mnt_log", buffer.getvalue())
+
+    def close(self):
+        if self._file.closed:
+            return
+        self.flush_mnt_log()
+        with self._lock:
+            self._file.close()
+
+
+class TraceReader:
+    def __init__(self, path: Path):
+        self.path = Path(path)
+
+    def records(self):
+        """Yield (kind, payload) for every record in the trace."""
+        with open(self.path, "rb") as f:
+            if f.read(len(MAGIC)) != MAGIC:
+                raise ValueError(f"{self.path} is not a trace file")
+            while header := f.read(RECORD_HEADER.size):
+                if len(header) < RECORD_HEADER.size:
+                    break
+                kind_size, payload_size = RECORD_HEADER.unpack(header)
+                kind = f.read(kind_size).decode()
+                payload = f.read(payload_size)
+                if len(payload) < payload_size:
+                    # The trace was cut off, e.g. the process was killed mid play
+                    break
+                yield kind, payload
+
+    def load(self) -> dict:
+        """
+        :return: {"meta", "chart", "actions", "stream", "commands", "mnt_log"}
+        """
+        result = {
+            "meta": None,
+            "chart": None,
+            "actions": None,
+            "stream": None,
+            "commands": [],
+            "mnt_log": {column: [] for column in MNT_LOG_COLUMNS + ["cmd"]},
+        }
+        for kind, payload in self.records():
+            if kind in ["meta", "chart"]:
+                result[kind] = json.loads(zlib.decompress(payload))
+            elif kind == "actions":
+                result["actions"] = ActionTimeline.from_bytes(payload)
+            elif kind == "stream":
+                result["stream"] = CommandStream.from_bytes(payload)
+            elif kind == "commands":
+                (elapsed,) = struct.unpack_from("<d", payload)
+                result["commands"].append((elapsed, payload[8:]))
+            elif kind == "mnt_log":
+                with np.load(io.BytesIO(payload), allow_pickle=False) as arrays:
+                    for column in MNT_LOG_COLUMNS:
+                        result["mnt_log"][column].extend(arrays[column].tolist())
+                    result["mnt_log"]["cmd"].extend(
+                        arrays["cmd"].tobytes().decode().split("\n")
+                    )
+        return result
+
+    def to_dict(self) -> dict:
+        """Plain data, in the layout of the old YAML debug dump plus the play log."""
+        trace = self.load()
+        meta = trace["meta"] or {}
+        mnt_log = trace["mnt_log"]
+        return {
+            **meta,
+            "chart": trace["chart"],
+            "actions": trace["actions"].to_dicts() if trace["actions"] else [],
+            "commands": (
+                trace["stream"].data.decode().splitlines() if trace["stream"] else []
+            ),
+            "published": [
+                {"elapsed": elapsed, "commands": data.decode().splitlines()}
+                for elapsed, data in trace["commands"]
+            ],
+            "mnt_log": [
+                dict(zip(mnt_log.keys(), event)) for event in zip(*mnt_log.values())
+            ],
+        }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Convert an autodori trace to text.")
+    parser.add_argument("trace", type=Path, help="Trace file to read")
+    parser.add_argument(
+        "--format",
+        type=str,
+        choices=["yaml", "json"],
+        default="yaml",
+        help="Output format",
+    )
+    parser.add_argument(
+        "--output",
+        type=Path,
+        help="Output file, stdout if not given",
+    )
+    args = parser.parse_args()
+
+    data = TraceReader(args.trace).to_dict()
+    if args.format == "yaml":
+        text = yaml.safe_dump(data, sort_keys=False, allow_unicode=True, indent=2)
+    else:
+        text = json.dumps(data, ensure_ascii=False, indent=2)
+
+    if args.output:
+        args.output.write_text(text, "utf-8")
+    else:
+        sys.stdout.write(text)
+
+
+if __name__ == "__main__":
+    main()
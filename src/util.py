@@ -1,5 +1,7 @@
+import datetime
 import json
 import logging
+import math
 import statistics
 import time
 from io import StringIO
@@ -7,13 +9,15 @@ from pathlib import Path
 
 import numpy as np
 import yaml
-from minitouchpy import CommandBuilder
+from minitouchpy import MNT, CommandBuilder, MNTServerCommunicateType
 from PIL import Image
 
+REFERENCE_RESOLUTION = (1280, 720)
+
 
 def get_runtime_info(resolution: tuple[int, int]):
-    x_zoom_multiple = resolution[0] / 1280
-    y_zoom_multiple = resolution[1] / 720
+    x_zoom_multiple = resolution[0] / REFERENCE_RESOLUTION[0]
+    y_zoom_multiple = resolution[1] / REFERENCE_RESOLUTION[1]
 
     def get_rounded_int_x(origin):
         return int(round(origin * x_zoom_multiple, 0))
@@ -46,63 +50,84 @@ def display_cmds(commands):
         logging.debug(log)
 
 
-def get_color_eval_in_range(image_array, start_row, end_row):
-    avg_color = np.zeros(3)
-    std_color = np.zeros(3)
-
-    for row_index in range(start_row, end_row + 1):
-        avg_color_row, std_color_row = evaluate_row_color(image_array, row_index)
-        avg_color += np.array(avg_color_row)
-        std_color += np.array(std_color_row)
-
-    avg_color /= end_row - start_row + 1
-    std_color /= end_row - start_row + 1
-
-    return avg_color, std_color
+def resolution_to_xformat(resolution: tuple[int, int]):
+    resolution_x, resolution_y = resolution
+    return f"{resolution_x}x{resolution_y}"
 
 
-def evaluate_row_color(image_array, row_index):
+def get_normalized_lane_position(lane: float) -> tuple[float, float]:
     """
-    评估图像中某一行的颜色（仅RGB）。
-    :param image_array: 输入图像，应为 (height, width, 3) 的 numpy 数组
-    :param row_index: 要评估的行索引
-    :return: 返回该行的平均颜色 (R, G, B) 和标准差
+    车道判定点的归一化坐标，与分辨率无关。
+    :param lane: 车道编号，可为小数
+    :return: (x, y)，取值范围 0~1
     """
-    row_data = image_array[row_index, :, :]  # 形状为 (width, 3)
+    reference_x, reference_y = REFERENCE_RESOLUTION
+    return ((127 + (lane + 0.5) * 147) / reference_x, 590 / reference_y)
 
-    # 分离出 R、G、B 通道
-    r, g, b = row_data[:, 0], row_data[:, 1], row_data[:, 2]
 
-    avg_color = (np.mean(r), np.mean(g), np.mean(b))
-    std_color = (np.std(r), np.std(g), np.std(b))
-
-    return avg_color, std_color
-
-
-def resolution_to_xformat(resolution: tuple[int, int]):
-    resolution_x, resolution_y = resolution
-    return f"{resolution_x}x{resolution_y}"
-
-
-def androidxy_to_MNTxy(android, mnt_resolution: tuple[int, int], orientation: int):
-    android_x, android_y = android
+def get_move_slices(
+    duration: float, distance: float, min_interval: float, tolerance: float = None
+) -> list[tuple[float, float]]:
+    """
+    把一段匀速移动按时间等分，每片对应一条 move 指令。
+    :param duration: 移动时长 (ms)
+    :param distance: 移动距离 (参考分辨率下的像素)
+    :param min_interval: 两条 move 之间的最短间隔 (ms)，超过设备触控采样率的指令没有意义
+    :param tolerance: 两条 move 之间允许的最大位置误差 (参考分辨率下的像素)，为 None 时每 min_interval 一条
+    :return: [(片起点, 片长度)]
+    """
+    count = max(1, math.ceil(duration / min_interval))
+    if tolerance:
+        count = min(count, max(1, math.ceil(distance / tolerance)))
+    size = duration / count
+    return [(i * size, size) for i in range(count)]
+
+
+def get_MNT_transform(
+    screen_resolution: tuple[int, int],
+    mnt_resolution: tuple[int, int],
+    orientation: int,
+) -> np.ndarray:
+    """
+    归一化坐标 -> minitouch 坐标的仿射变换矩阵 (2, 3)。
+    先按屏幕分辨率缩放，再按屏幕方向旋转到 minitouch 坐标系。
+    """
+    screen_x, screen_y = screen_resolution
     resolution_x, resolution_y = mnt_resolution
+    return np.array(
+        {
+            0: [[screen_x, 0, 0], [0, screen_y, 0]],
+            1: [[0, -screen_y, resolution_x], [screen_x, 0, 0]],
+            2: [[-screen_x, 0, resolution_x], [0, -screen_y, resolution_y]],
+            3: [[0, screen_y, 0], [-screen_x, 0, resolution_y]],
+        }[orientation],
+        dtype=np.float64,
+    )
+
+
+def normalizedxy_to_MNTxy(points: np.ndarray, transform: np.ndarray) -> np.ndarray:
+    """
+    :param points: (N, 2) 的归一化坐标
+    :param transform: get_MNT_transform 的返回值
+    :return: (N, 2) 的 minitouch 整数坐标
+    """
+    return np.rint(points @ transform[:, :2].T + transform[:, 2]).astype(np.int64)
 
-    list_ = [-1] * 4
-    list_[orientation] = android_x
-    list_[orientation + 1] = android_y
-    for i in range(len(list_)):
-        if list_[i] == -1:
-            if i == 0:
-                list_[0] = resolution_x - list_[2]
-            elif i == 1:
-                list_[1] = resolution_y - list_[3]
-            elif i == 2:
-                list_[2] = resolution_x - list_[0]
-            elif i == 3:
-                list_[3] = resolution_y - list_[1]
 
-    return (int(list_[0]), int(list_[1]))
+def mnt_write(mnt: MNT, segments):
+    """
+    直接向 minitouch 写入原始指令字节，不经过 CommandBuilder。
+    :param segments: bytes / memoryview 的列表，按顺序写入
+    """
+    if mnt._communicate_type == MNTServerCommunicateType.SOCKET:
+        for segment in segments:
+            mnt.client.sendall(segment)
+    else:
+        stdin = mnt.mnt_process.stdin
+        stdin.flush()
+        for segment in segments:
+            stdin.buffer.write(segment)
+        stdin.buffer.flush()
 
 
 def generate_function_call_str(function, args, kwargs):
@@ -193,3 +218,21 @@ class TestSpeedTimer:
             print(f"Standard Deviation: {stddev * 1000:.6f} ms")
             print(f"Min Time: {min(self.execution_times) * 1000:.6f} ms")
             print(f"Max Time: {max(self.execution_times) * 1000:.6f} ms")
+
+
+def configure_log():
+    Path("debug").mkdir(exist_ok=True)
+    logging.basicConfig(
+        level=logging.DEBUG,
+        format="%(asctime)s[%(levelname)s][%(name)s] %(message)s",
+        handlers=[
+            logging.StreamHandler(),
+            logging.FileHandler(
+                "debug/autodori-{}.log".format(
+                    datetime.datetime.now().strftime("%Y%m%d-%H%M%S")
+                ),
+                mode="w",
+                encoding="utf-8",
+            ),
+        ],
+    )
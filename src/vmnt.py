@@ -0,0 +1,301 @@
+import argparse
+import json
+import logging
+import os
+import random
+import statistics
+import threading
+import time
+import types
+from pathlib import Path
+from typing import Callable, Union
+
+import numpy as np
+from minitouchpy import MNTEvATive7LogEventData, MNTEvent, MNTServerCommunicateType
+
+from timeline import DOWN, MOVE, UP, ActionTimeline
+
+# ms, as (mean, standard deviation) of a normal distribution clipped at 0. "w" is how
+# much longer than asked a wait takes, "interval" the gap before each command.
+DEFAULT_LATENCY = {
+    "d": (0.05, 0.02),
+    "m": (0.05, 0.02),
+    "u": (0.05, 0.02),
+    "c": (0.4, 0.2),
+    "w": (0.1, 0.05),
+    "interval": (0.02, 0.01),
+}
+
+
+class VirtualMNT:
+    """
+    In-process stand-in for the EvATive7 minitouch, for playback without a device.
+
+    It looks like an STDIO MNT to util.mnt_write. A simulator thread runs the
+    commands written to it and calls `callback` with MNTEvATive7LogEventData for
+    every command, as the real build does. Contacts take effect at each commit, and
+    the resulting touches are kept per finger to compare with the chart.
+
+    With realtime=False the device runs on a simulated clock, where commands and
+    waits take exactly their sampled cost and nothing ever sleeps. With
+    realtime=True waits and costs really elapse, so a producer that falls
+    behind shows up as late touches.
+    """
+
+    def __init__(
+        self,
+        callback: Callable = None,
+        max_x: int = 720,
+        max_y: int = 1280,
+        max_contacts: int = 10,
+        latency: dict[str, Union[tuple[float, float], Callable[[], float]]] = None,
+        realtime: bool = False,
+        seed: int = None,
+    ):
+        """
+        :param latency: cost of each command type in ms, as (mean, stddev) or a function
+            returning one sample. Types not given use DEFAULT_LATENCY.
+        """
+        self.callback = callback
+        self.max_x = max_x
+        self.max_y = max_y
+        self.max_contacts = max_contacts
+        self.realtime = realtime
+        self._random = random.Random(seed)
+        self._latency = {**DEFAULT_LATENCY, **(latency or {})}
+        self._communicate_type = MNTServerCommunicateType.STDIO
+
+        read_fd, write_fd = os.pipe()
+        self._reader = os.fdopen(read_fd, "rb")
+        self.mnt_process = types.SimpleNamespace(
+            stdin=os.fdopen(write_fd, "w", encoding="utf-8")
+        )
+
+        self._clock = 0.0
+        self._start_time: float = None
+        self._pending: dict[int, tuple] = {}
+        # finger: [(time, type, x, y)], type is timeline.DOWN, MOVE or UP
+        self.touches: dict[int, list[tuple[float, int, int, int]]] = {}
+        self.commands = 0
+        self.errors = []
+
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def _sample(self, type_: str) -> float:
+        latency = self._latency[type_]
+        if callable(latency):
+            return max(0.0, latency())
+        mean, stddev = latency
+        return max(0.0, self._random.gauss(mean, stddev))
+
+    def now(self) -> float:
+        """Device time in ms since the first command."""
+        if not self.realtime:
+            return self._clock
+        if self._start_time is None:
+            return 0.0
+        return (time.perf_counter() - self._start_time) * 1000
+
+    def _spend(self, duration: float):
+        if not self.realtime:
+            self._clock += duration
+            return
+        # time.sleep overshoots by about as much as a command costs, so only sleep
+        # through the bulk of long waits and spin for the rest
+        deadline = time.perf_counter() + duration / 1000
+        if duration > 2:
+            time.sleep((duration - 1) / 1000)
+        while time.perf_counter() < deadline:
+            pass
+
+    def _run(self):
+        for line in self._reader:
+            cmd = line.decode().strip()
+            if not cmd:
+                continue
+            if self._start_time is None:
+                self._start_time = time.perf_counter()
+            try:
+                self._execute(cmd)
+            except Exception as e:
+                self.errors.append(f"{cmd}: {e}")
+
+    def _execute(self, cmd: str):
+        parts = cmd.split(" ")
+        type_ = parts[0]
+
+        self._spend(self._sample("interval"))
+        start_time = self.now()
+        if type_ == "w":
+            self._spend(int(parts[1]) + self._sample("w"))
+        else:
+            self._spend(self._sample(type_ if type_ in self._latency else "c"))
+        end_time = self.now()
+
+        if type_ == "d":
+            self._pending[int(parts[1])] = (DOWN, int(parts[2]), int(parts[3]))
+        elif type_ == "m":
+            finger = int(parts[1])
+            # A move in the same commit as the down keeps the contact a down
+            down = self._pending.get(finger, (None,))[0] == DOWN
+            self._pending[finger] = (
+                DOWN if down else MOVE,
+                int(parts[2]),
+                int(parts[3]),
+            )
+        elif type_ == "u":
+            self._pending[int(parts[1])] = (UP, 0, 0)
+        elif type_ == "c":
+            for finger, (touch_type, x, y) in self._pending.items():
+                self.touches.setdefault(finger, []).append((end_time, touch_type, x, y))
+            self._pending = {}
+
+        self.commands += 1
+        if self.callback is not None:
+            cost = end_time - start_time
+            self.callback(
+                MNTEvent.EVATIVE7_LOG,
+                MNTEvATive7LogEventData(start_time, end_time, cost, cmd),
+            )
+
+    def stop(self):
+        """Close the input and wait for the device to run every command it got."""
+        if not self.mnt_process.stdin.closed:
+            self.mnt_process.stdin.close()
+        self._thread.join()
+        self._reader.close()
+
+    def report(self, actions: ActionTimeline) -> dict:
+        """
+        Compare touches with the chart. The n-th down and up of each finger on the
+        device is matched with the n-th of that finger in `actions`, and the device
+        clock is aligned to the chart at the first down.
+
+        :return: number of matched downs and ups, and their error in ms
+        """
+        array = actions.array
+        errors = {}
+        first = None
+        expected = {}
+        for type_ in [DOWN, UP]:
+            rows = array[array["type"] == type_]
+            for finger in np.unique(rows["finger"]).tolist():
+                chart_times = rows["time"][rows["finger"] == finger]
+                device_times = [
+                    touch[0]
+                    for touch in self.touches.get(finger, [])
+                    if touch[1] == type_
+                ]
+                expected[(type_, finger)] = (chart_times, device_times)
+                if type_ == DOWN and chart_times.size and device_times:
+                    if first is None or chart_times[0] < first[0]:
+                        first = (float(chart_times[0]), device_times[0])
+
+        if first is None:
+            first = (0.0, 0.0)
+
+        missing = 0
+        for (type_, finger), (chart_times, device_times) in expected.items():
+            missing += abs(len(chart_times) - len(device_times))
+            matched = min(len(chart_times), len(device_times))
+            errors.setdefault(type_, []).extend(
+                (
+                    np.array(device_times[:matched])
+                    - first[1]
+                    - (chart_times[:matched] - first[0])
+                ).tolist()
+            )
+
+        def describe(values: list[float]) -> dict:
+            if not values:
+                return {"count": 0}
+            absolute = np.abs(values)
+            return {
+                "count": len(values),
+                "mean": statistics.mean(values),
+                "median": statistics.median(values),
+                "p95_abs": float(np.percentile(absolute, 95)),
+                "max_abs": float(absolute.max()),
+            }
+
+        return {
+            "downs": describe(errors.get(DOWN, [])),
+            "ups": describe(errors.get(UP, [])),
+            "missing": missing,
+            "commands": self.commands,
+            "device_time": self.now(),
+            "errors": self.errors,
+        }
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Play a chart through playback.play_song on a virtual minitouch."
+    )
+    parser.add_argument("song_id", type=str, help="Bestdori song id")
+    parser.add_argument(
+        "difficulty",
+        type=str,
+        choices=["easy", "normal", "hard", "expert", "special"],
+    )
+    parser.add_argument(
+        "--fixture",
+        type=Path,
+        help="Specify a Bestdori chart JSON to play instead of fetching the chart",
+    )
+    parser.add_argument(
+        "--realtime",
+        action="store_true",
+        help="Specify if waits really elapse on the device",
+    )
+    parser.add_argument(
+        "--latency",
+        type=json.loads,
+        help='Specify command costs in ms as JSON, e.g. {"c": [0.4, 0.2]}',
+    )
+    parser.add_argument("--seed", type=int, default=0, help="Specify the random seed")
+    args = parser.parse_args()
+
+    import playback
+    from chart import Chart
+    from util import configure_log
+
+    configure_log()
+    mnt = VirtualMNT(
+        playback.mnt_callback,
+        latency={type_: tuple(value) for type_, value in (args.latency or {}).items()},
+        realtime=args.realtime,
+        seed=args.seed,
+    )
+    playback.mnt = mnt
+
+    if args.fixture:
+        chart = Chart(
+            (args.song_id, args.difficulty),
+            chart_data=json.loads(args.fixture.read_text("utf-8")),
+        )
+        chart.notes_to_actions(
+            playback.DEFAULT_MOVE_SLICE_SIZE,
+            playback.MOVE_TOLERANCE,
+            playback.FRAME_QUANTUM,
+        )
+    else:
+        chart = Chart((args.song_id, args.difficulty))
+        chart.load_actions(
+            playback.DEFAULT_MOVE_SLICE_SIZE,
+            playback.MOVE_TOLERANCE,
+            playback.FRAME_QUANTUM,
+        )
+    chart.compile_stream((1280, 720), (mnt.max_x, mnt.max_y), 1)
+    playback.current_chart = chart
+
+    playback.play_song(wait_first=False)
+    mnt.stop()
+    report = mnt.report(chart.actions)
+    logging.info(f"Offset: {playback.OFFSET}")
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    main()